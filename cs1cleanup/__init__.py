@@ -1 +1,2 @@
 from .cs1cleanup import *
+from .batch import suggest_dates, validate_dates
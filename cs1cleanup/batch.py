@@ -0,0 +1,83 @@
+# encoding=utf8
+# Batch versions of get_date_suggestion and validate_date, for offline
+# analyses over large numbers of values. Each distinct value is only
+# processed once, and large batches can be spread over several processes.
+from __future__ import unicode_literals
+
+from itertools import repeat
+
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+    # Python 2 without the futures backport
+    ProcessPoolExecutor = None
+
+from . import cs1cleanup as core
+
+
+def unique(values):
+    """
+    Return the distinct values in order of first appearance, and for each
+    of the input values the position of that value in the distinct list.
+    """
+    positions = {}
+    distinct = []
+    index = []
+    for value in values:
+        pos = positions.get(value)
+        if pos is None:
+            pos = positions[value] = len(distinct)
+            distinct.append(value)
+        index.append(pos)
+    return distinct, index
+
+
+def init_worker():
+    # The suggestion store connection can't be shared with the parent process
+    core.suggestion_store = None
+
+
+def in_worker(func, *args):
+    # Call func in a pool process. The worker is set up here rather than with
+    # a pool initializer, which needs Python 3.7.
+    init_worker()
+    return func(*args)
+
+
+def suggest_chunk(values, field_name):
+    return [core.get_date_suggestion(value, field_name) for value in values]
+
+
+def validate_chunk(values):
+    return [core.validate_date(value) for value in values]
+
+
+def run_batch(func, values, args, processes, chunksize):
+    distinct, index = unique(values)
+    if processes > 1 and ProcessPoolExecutor is not None and len(distinct) > chunksize:
+        chunks = [distinct[i:i + chunksize] for i in range(0, len(distinct), chunksize)]
+        results = []
+        with ProcessPoolExecutor(processes) as executor:
+            for chunk_results in executor.map(in_worker, repeat(func), chunks, *[repeat(arg) for arg in args]):
+                results.extend(chunk_results)
+    else:
+        results = func(distinct, *args)
+    return [results[pos] for pos in index]
+
+
+def suggest_dates(values, field_name='(batch)', processes=1, chunksize=1000):
+    """
+    Return get_date_suggestion(value, field_name) for each of the values, in
+    input order. With processes > 1, batches with more than `chunksize`
+    distinct values are split into chunks that are processed in a pool of
+    that many processes. The suggestion store is not used in the workers.
+    """
+    return run_batch(suggest_chunk, values, (field_name,), processes, chunksize)
+
+
+def validate_dates(values, processes=1, chunksize=1000):
+    """
+    Return validate_date(value), a (valid, problem) tuple, for each of the
+    values, in input order. See suggest_dates for `processes` and `chunksize`.
+    """
+    return run_batch(validate_chunk, values, (), processes, chunksize)
@@ -0,0 +1,124 @@
+# encoding=utf8
+# Bulk validation of date values with pandas, for audits over a whole column
+# of values. The date rules are matched with vectorized string operations,
+# and the checks are done as array comparisons. Only the values that are not
+# found to be valid that way are passed to validate_date.
+from __future__ import unicode_literals
+
+import re
+from itertools import count
+
+try:
+    import numpy as np
+    import pandas as pd
+except ImportError:
+    np = None
+    pd = None
+
+from . import cs1cleanup as core
+from .batch import validate_dates
+
+# With pyarrow, the string operations are done by pyarrow instead of in a
+# loop over the values
+string_dtype = object
+if pd is not None:
+    try:
+        import pyarrow
+        string_dtype = pd.ArrowDtype(pyarrow.string())
+    except (ImportError, AttributeError):
+        # No pyarrow, or pandas before 1.5
+        pass
+
+
+# The vector_ functions are vectorized versions of the check_ functions. They
+# are given a Series with the group from values that all matched the rule.
+
+def vector_year(col):
+    # Both year patterns in check_year are covered by the rule patterns
+    return col.astype(float) < core.current_year + 2
+
+
+def vector_numeric_month(col):
+    month = col.astype(float)
+    return (month >= 1) & (month <= 12)
+
+
+def vector_day(col, allow_zero_prefix=True):
+    day = col.astype(float)
+    result = (day >= 1) & (day <= 31)
+    if not allow_zero_prefix:
+        result &= ~col.str.startswith('0')
+    return result
+
+
+def vector_month(col, include_seasons=False):
+    names = core.month_and_season_names if include_seasons else core.month_names
+    value = col.str[:1].str.lower() + col.str[1:]
+    return (col.str.len() >= 2) & value.isin(names)
+
+
+vector_checks = {
+    core.check_year: vector_year,
+    core.check_numeric_month: vector_numeric_month,
+    core.check_day: vector_day,
+    core.check_month: vector_month,
+}
+
+group_re = re.compile(r'(?<!\\)\((?!\?)')
+
+
+def name_groups(name, pattern):
+    # pyarrow needs every group in a pattern to be named
+    numbers = count(1)
+    return group_re.sub(lambda m: '(?P<%s_%d>' % (name, next(numbers)), pattern)
+
+
+# The date rules with every group named and digits restricted to ASCII
+# digits, so that the groups can be converted to numbers with astype
+bulk_rules = [(name, '^(?:%s)$' % name_groups(name, pattern.replace(r'\d', '[0-9]')), checks)
+              for name, pattern, checks in core.date_rules]
+
+
+def validate_dates_bulk(values):
+    """
+    Validate a sequence of date values, such as a list, an array or a pandas
+    Series. Returns a boolean array that is True for the valid values, and an
+    object array with the problem for each invalid value (None if there is
+    no specific problem, as with validate_date). Missing values are treated
+    as empty strings. Requires pandas, and is only faster than validate_dates
+    with pyarrow installed as well.
+
+    The date rules are matched against all the values at once, and a value
+    belongs to the first rule it matches, as with check_date. The groups are
+    then extracted from the values that matched, and checked as arrays. The
+    values found to be valid that way would also be valid with validate_date.
+    All the other values are validated with validate_dates, which also finds
+    the problem. This includes values with comments, since they don't match
+    any rule here.
+    """
+    if pd is None:
+        raise ImportError('validate_dates_bulk requires pandas')
+
+    text = pd.Series(np.asarray(values, dtype=object)).fillna('').astype(string_dtype)
+    mask = np.zeros(len(text), dtype=bool)
+
+    remaining = np.arange(len(text))
+    for name, pattern, checks in bulk_rules:
+        matched = text.iloc[remaining].str.match(pattern).to_numpy(dtype=bool)
+        if not matched.any():
+            continue
+        positions = remaining[matched]
+        remaining = remaining[~matched]
+        ok = np.ones(len(positions), dtype=bool)
+        if checks:
+            groups = text.iloc[positions].str.extract(pattern, expand=True)
+            for check in checks:
+                ok &= vector_checks[check[0]](groups.iloc[:, check[1] - 1], *check[2:]).to_numpy(dtype=bool)
+        mask[positions[ok]] = True
+
+    problems = np.full(len(text), None, dtype=object)
+    rest = np.flatnonzero(~mask)
+    for pos, (is_valid, problem) in zip(rest, validate_dates(text.iloc[rest].tolist())):
+        mask[pos] = is_valid
+        problems[pos] = problem
+    return mask, problems
@@ -0,0 +1,96 @@
+# encoding=utf8
+from __future__ import unicode_literals
+
+import logging
+import threading
+from collections import OrderedDict
+
+missing = object()
+
+
+class LRUCache(object):
+    """
+    A bounded mapping that evicts the least recently used entry once it
+    holds more than `maxsize` entries. Counts hits and misses so that
+    callers can report on how useful the cache is.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        try:
+            value = self.data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.data[key] = value  # Move to the most recently used end
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.data.pop(key, None)
+        self.data[key] = value
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def resize(self, maxsize):
+        self.maxsize = maxsize
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def clear(self):
+        self.data.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+class LogCapture(logging.Handler):
+    """
+    Logging handler that keeps (level, msg, args) for every record logged
+    from the thread that created it. Records from other threads, which log
+    to the same logger at the same time, are left out.
+    """
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+        self.thread = threading.current_thread().ident
+
+    def emit(self, record):
+        if record.thread == self.thread:
+            self.records.append((record.levelno, record.msg, record.args))
+
+
+def call_logged(cache, logger, key, func, *args):
+    """
+    Return func(*args), memoized in `cache` under `key`. The messages func
+    sends to `logger` are stored with the result and logged again on cache
+    hits, so the log is the same whether or not the result was cached.
+    """
+    entry = cache.get(key, missing)
+    if entry is missing:
+        capture = LogCapture()
+        logger.addHandler(capture)
+        try:
+            result = func(*args)
+        finally:
+            logger.removeHandler(capture)
+        cache.set(key, (result, tuple(capture.records)))
+        return result
+
+    result, records = entry
+    for level, msg, msg_args in records:
+        if not isinstance(msg_args, tuple):
+            msg_args = (msg_args,)
+        logger.log(level, msg, *msg_args)
+    return result
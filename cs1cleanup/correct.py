@@ -1,32 +1,95 @@
 # encoding=utf8
-# Based on <http://norvig.com/spell-correct.html>
+# Spelling correction of month and season names, using a symmetric delete
+# index as in SymSpell <https://github.com/wolfgarbe/SymSpell>. Words in
+# the word list and the word to correct are both reduced by deleting up to
+# `index_distance` characters, and words that share a reduced form are
+# candidates, which are then checked with a real edit distance.
 from __future__ import unicode_literals
 
 wordlist = ['januar', 'februar', 'mars', 'april', 'mai', 'juni', 'juli', 'august', 'september', 'oktober', 'november', 'desember', 'våren', 'sommeren', 'høsten', 'vinteren', 'julen']
 
-alphabet = 'abcdefghijklmnopqrstuvwxyzæøå'
+index_distance = 2
 
 
-def edits1(word):
-    splits = [(word[:i], word[i:]) for i in range(len(word) + 1)]
-    deletes = [a + b[1:] for a, b in splits if b]
-    transposes = [a + b[1] + b[0] + b[2:] for a, b in splits if len(b) > 1]
-    replaces = [a + c + b[1:] for a, b in splits for c in alphabet if b]
-    inserts = [a + c + b for a, b in splits for c in alphabet]
-    return set(deletes + transposes + replaces + inserts)
+def deletes(word, n):
+    """
+    Return the set of strings that can be made by deleting up to n
+    characters from word, including word itself.
+    """
+    result = set([word])
+    edge = result
+    for i in range(n):
+        edge = set(w[:j] + w[j + 1:] for w in edge for j in range(len(w)))
+        result |= edge
+    return result
 
 
-def known_edits2(word):
-    return set(e2 for e1 in edits1(word) for e2 in edits1(e1) if e2 in wordlist)
+def build_index(words, n):
+    index = {}
+    for word in words:
+        for d in deletes(word, n):
+            index.setdefault(d, set()).add(word)
+    return index
 
 
-def known(words):
-    return set(w for w in words if w in wordlist)
+index = build_index(wordlist, index_distance)
+wordlist_order = dict((w, i) for i, w in enumerate(wordlist))
 
 
-def correct(word):
-    if len(word) <= 5:
-        candidates = known([word]) or known(edits1(word)) or [word]
-    else:
-        candidates = known([word]) or known(edits1(word)) or known_edits2(word) or [word]
-    return candidates.pop()
+def distance(a, b, max_distance=None):
+    """
+    Damerau-Levenshtein distance between a and b, in the optimal string
+    alignment variant (adjacent transpositions, no substring edited twice).
+    If max_distance is given, the calculation stops as soon as the distance
+    is known to exceed it, and max_distance + 1 is returned.
+    """
+    if max_distance is not None and abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    prev2 = None
+    prev = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        cur = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                cur[j] = min(cur[j], prev2[j - 2] + 1)
+        # Later rows can only build on this row and the one before it
+        if max_distance is not None and min(cur) > max_distance and min(prev) > max_distance:
+            return max_distance + 1
+        prev2, prev = prev, cur
+    if max_distance is not None and prev[len(b)] > max_distance:
+        return max_distance + 1
+    return prev[len(b)]
+
+
+def match(word, max_distance=index_distance):
+    """
+    Return the words in the word list that are at most max_distance edits
+    away from word, as a list of (word, distance) tuples sorted by distance.
+    Ties are sorted in word list order, so the result is always the same.
+    """
+    if max_distance > index_distance:
+        raise ValueError('The index only supports distances up to %d' % index_distance)
+    found = {}
+    for d in deletes(word, max_distance):
+        for candidate in index.get(d, ()):
+            if candidate not in found:
+                found[candidate] = distance(word, candidate, max_distance)
+    return sorted([(w, dist) for w, dist in found.items() if dist <= max_distance],
+                  key=lambda x: (x[1], wordlist_order[x[0]]))
+
+
+def correct(word, allow_ambiguous=True):
+    """
+    Return the closest word in the word list, or word itself if there is no
+    word within one edit (two edits for words longer than five letters).
+    If allow_ambiguous is False, word is also returned if there is more
+    than one closest word.
+    """
+    found = match(word, 1 if len(word) <= 5 else 2)
+    if not found:
+        return word
+    if not allow_ambiguous and len(found) > 1 and found[1][1] == found[0][1]:
+        return word
+    return found[0][0]
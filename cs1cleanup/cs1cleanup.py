@@ -11,14 +11,25 @@ import time
 import argparse
 import codecs
 import json
+import hashlib
+import inspect
 from datetime import datetime
+from functools import partial
 from six.moves.urllib.parse import quote
 from six.moves import input
 
 from mwclient import Site
+from mwclient.errors import ProtectedPageError
 from mwtemplates import TemplateEditor
 
+from .cache import LRUCache, call_logged
 from .correct import correct
+from .fetch import category_members, category_pages, fetch_pages
+from .pipeline import pipeline
+from .lexicon import lexicon, data_path as lexicon_data_path
+from .store import PageStateStore, SuggestionStore
+from .throttle import EditScheduler
+from .wikitext import find_templates, find_edit_section, minimal_edits, splice
 
 import logging
 
@@ -42,256 +53,301 @@ if os.path.exists('checked_manually.txt'):
 
 logger.debug('Read %d entries from checked_manually.txt', len(checked_manually))
 
-months = ['januar', 'februar', 'mars', 'april', 'mai', 'juni', 'juli', 'august', 'september', 'oktober', 'november', 'desember']
-seasons = ['våren', 'sommeren', 'høsten', 'vinteren', 'julen']
-monthsdict = {
-    'jan': 'januar',
-    'feb': 'februar',
-    'mar': 'mars',
-    'apr': 'april',
-    'jun': 'juni',
-    'jul': 'juli',
-    'aug': 'august',
-    'sep': 'september',
-    'sept': 'september',
-    'oct': 'oktober',
-    'okt': 'oktober',
-    'nov': 'november',
-    'dec': 'desember',
-    'des': 'desember',
-    'march': 'mars',
-    'января': 'januar',
-    'февраля': 'februar',
-    'марта': 'mars',
-    'апреля': 'april',
-    'мая': 'mai',
-    'июня': 'juni',
-    'июля': 'juli',
-    'августа': 'august',
-    'сентября': 'september',
-    'октября': 'oktober',
-    'ноября': 'november',
-    'декабря': 'desember',
-}
-seasonsdict = {
-    'vår': 'våren',
-    'sommer': 'sommeren',
-    'høst': 'høsten',
-    'vinter': 'vinteren',
-    'spring': 'våren',
-    'summer': 'sommeren',
-    'autumn': 'høsten',
-    'fall': 'høsten',
-    'winter': 'vinteren',
-    'christmas': 'julen',
-}
+months = lexicon.canonical['month']
+seasons = lexicon.canonical['season']
 current_year = time.localtime().tm_year
 
 
+def read_words(path):
+    words = set()
+    with codecs.open(path, 'r', 'utf8') as f:
+        for line in f:
+            words.update(line.split('#')[0].split())
+    return words
+
+
+stopwords_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'stopwords.txt')
+
+# Words that are never month or season names. Add to this set to
+# make get_month and get_month_or_season reject more words up front.
+month_stopwords = read_words(stopwords_path)
+
+# Words that get_month and get_month_or_season could not match earlier
+month_misses = LRUCache(10000)
+month_or_season_misses = LRUCache(10000)
+
+
 def get_month(val):
     val = val.lower()
-    if NumericMonthValidator(val).valid:
-        return val
-    if MonthValidator(val).valid:
+    if val in month_stopwords or month_misses.get(val):
+        return None
+    if validate_numeric_month(val)[0]:
         return val
-    elif val in monthsdict:
-        return monthsdict[val]
-    else:
-        suggest = correct(val)
-        if suggest != val:
-            return suggest
+    month = lexicon.lookup(val)
+    if month is not None:
+        return month
+    suggest = correct(val, allow_ambiguous=False)
+    if suggest != val:
+        return suggest
     logger.debug('Could not match "%s" to month or season name', val)
+    month_misses.set(val, True)
     return None
 
 
 def get_month_or_season(val):
     val = val.lower()
-    if MonthValidator(val, True).valid:
-        return val
-    elif val in monthsdict:
-        return monthsdict[val]
-    elif val in seasonsdict:
-        return seasonsdict[val]
-    else:
-        suggest = correct(val)
-        if suggest != val:
-            return suggest
+    if val in month_stopwords or month_or_season_misses.get(val):
+        return None
+    month = lexicon.lookup(val, include_seasons=True)
+    if month is not None:
+        return month
+    suggest = correct(val, allow_ambiguous=False)
+    if suggest != val:
+        return suggest
+    month_or_season_misses.set(val, True)
     return None
 
 
-class Validator(object):
+comment_re = re.compile('<!--.*?-->')
 
-    def __init__(self, value):
-        self.problem = None
-        self.value = re.sub('<!--.*?-->', '', value).strip() # Ignore comments when checking for validity
-        self.valid = True
-        self.validate()
+VALID = (True, None)
+INVALID = (False, None)
 
-    def validate(self):
-        pass
+month_names = frozenset(months)
+month_and_season_names = frozenset(months + seasons)
 
-    def is_valid(self):
-        return True
+date_cache = LRUCache(50000)
+year_cache = LRUCache(10000)
+suggestion_cache = LRUCache(10000)
+suggestion_store = None
+edit_scheduler = EditScheduler()
 
-    def is_invalid(self, problem=None):
-        self.valid = False
-        self.problem = problem
-        return False
 
+def strip_comments(value):
+    # Ignore comments when checking for validity
+    if '<!--' in value:
+        value = comment_re.sub('', value)
+    return value.strip()
 
-class YearValidator(Validator):
 
-    def not_future_year(self, value):
-        if int(value) >= current_year + 2:
-            return self.is_invalid('Publiseringsår mer enn ett år inn i fremtiden')
-
-        return self.is_valid()
-
-    def validate(self):
-        if re.match('^$', self.value):
-            return self.is_valid()  # It's empty, that's ok
-
-        # 2014
-        m = re.match('^(\d{4})$', self.value)
-        if m:
-            # Publication dates should normally not be in the future
-            return self.not_future_year(m.group(1))
-
-        m = re.match('^ca?\. (\d{4})$', self.value)
-        if m:
-            return self.not_future_year(m.group(1))
-
-        return self.is_invalid()
-
-
-class MonthValidator(Validator):
+def compile_rules(rules):
+    """
+    Combine a list of (name, pattern, checks) rules into a single anchored
+    alternation with one named group per rule. Returns the compiled pattern
+    and a dict mapping each rule name to its checks, with the group numbers
+    translated to group numbers in the combined pattern.
+    """
+    pattern = re.compile('^(?:%s)$' % '|'.join('(?P<%s>%s)' % (name, rule) for name, rule, checks in rules))
+    dispatch = {}
+    for name, rule, checks in rules:
+        offset = pattern.groupindex[name]
+        dispatch[name] = [(check[0], offset + check[1], check[2:]) for check in checks]
+    return pattern, dispatch
 
-    def __init__(self, value, include_seasons=False):
-        self.include_seasons = include_seasons
-        super(MonthValidator, self).__init__(value)
 
-    def validate(self):
-        if len(self.value) < 2:
-            return self.is_invalid('Ikke kjent navn på måned eller årstid')
-        value = self.value[0].lower() + self.value[1:]  # ignore case on first character
-        if value not in months and (not self.include_seasons or value not in seasons):
-            return self.is_invalid('Ikke kjent navn på måned eller årstid')
-        return self.is_valid()
+year_patterns = [
+    re.compile(r'^(\d{4})$'),  # 2014
+    re.compile(r'^ca?\. (\d{4})$'),  # ca. 2014
+]
 
 
-class NumericMonthValidator(Validator):
+def check_year(value):
+    if value == '':
+        return VALID  # It's empty, that's ok
 
-    def validate(self):
-        try:
-            value = int(self.value)
-            if value < 1 or value > 12:
-                return self.is_invalid('Månedsnummer utenfor rekkevidde 1-12')
-            return self.is_valid()
-
-        except ValueError:
-            return self.is_invalid('Ukjent månedsnummer')
+    for pattern in year_patterns:
+        m = pattern.match(value)
+        if m:
+            # Publication dates should normally not be in the future
+            if int(m.group(1)) >= current_year + 2:
+                return (False, 'Publiseringsår mer enn ett år inn i fremtiden')
+            return VALID
+
+    return INVALID
+
+
+def check_month(value, include_seasons=False):
+    if len(value) < 2:
+        return (False, 'Ikke kjent navn på måned eller årstid')
+    value = value[0].lower() + value[1:]  # ignore case on first character
+    if value not in (month_and_season_names if include_seasons else month_names):
+        return (False, 'Ikke kjent navn på måned eller årstid')
+    return VALID
+
+
+def check_numeric_month(value):
+    try:
+        value = int(value)
+    except ValueError:
+        return (False, 'Ukjent månedsnummer')
+    if value < 1 or value > 12:
+        return (False, 'Månedsnummer utenfor rekkevidde 1-12')
+    return VALID
+
+
+def check_day(value, allow_zero_prefix=True):
+    try:
+        ival = int(value)
+    except ValueError:
+        return (False, 'Klarte ikke å tolke dagverdien')
+    if ival < 1 or ival > 31:
+        return (False, 'Dag utenfor rekkevidde 1-31')
+    if not allow_zero_prefix and str(ival) != value:
+        return (False, 'Dag har 0-prefiks')
+    return VALID
+
+
+# Each rule is (name, pattern, checks), where each check is
+# (function, group number, *extra arguments). The checks are run in order
+# and the first one that fails decides the problem.
+date_rules = [
+    # empty
+    ('empty', '', ()),
+    ('udatert', 'udatert', ()),
+    ('ud', r'u\.d\.', ()),
+
+    # 2014-01-01
+    ('iso', r'(\d{4})-(\d{2})-(\d{2})', (
+        (check_year, 1), (check_numeric_month, 2), (check_day, 3),
+    )),
+
+    # 2014, ca. 2014
+    ('year', r'(ca?\. )?(\d{4})', (
+        (check_year, 2),
+    )),
+
+    # 2014–2015
+    ('year_range', r'(\d{4})–(\d{4})', (
+        (check_year, 1), (check_year, 2),
+    )),
+
+    # 1.1.2001
+    ('numeric', r'(\d\d?)\.(\d\d?)\.(\d{4})', (
+        (check_day, 1), (check_numeric_month, 2), (check_year, 3),
+    )),
+
+    # 1. januar 2014
+    ('day_month_year', r'(\d\d?)\. ([a-z]+) (\d{4})', (
+        (check_day, 1, False), (check_month, 2, False), (check_year, 3),
+    )),
+
+    # 1.–2. januar 2014
+    ('day_range', r'(\d\d?)\.–(\d\d?)\. ([a-z]+) (\d{4})', (
+        (check_day, 2, False), (check_day, 2, False), (check_month, 3, False), (check_year, 4),
+    )),
+
+    # 1. januar – 2. februar 2014
+    ('day_month_range', r'(\d\d?)\. ([a-z]+) – (\d\d?)\. ([a-z]+) (\d{4})', (
+        (check_day, 1, False), (check_month, 2, False), (check_day, 3, False), (check_month, 4, False), (check_year, 5),
+    )),
+
+    # 1. januar 2014 – 1. februar 2015
+    ('date_range', r'(\d\d?)\. ([a-z]+) (\d{4}) – (\d\d?)\. ([a-z]+) (\d{4})', (
+        (check_day, 1, False), (check_month, 2, False), (check_year, 3), (check_day, 4, False), (check_month, 5, False), (check_year, 6),
+    )),
+
+    # januar 2014
+    ('month_year', r'([A-Za-zøå]+) (\d{4})', (
+        (check_month, 1, True), (check_year, 2),
+    )),
+
+    # januar–februar 2014
+    ('month_range', r'([A-Za-zøå]+)–([a-z]+) (\d{4})', (
+        (check_month, 1, True), (check_month, 2, True), (check_year, 3),
+    )),
+
+    # januar 2014 – februar 2015
+    ('month_year_range', r'([A-Za-zøå]+) (\d{4}) – ([a-zøå]+) (\d{4})', (
+        (check_month, 1, True), (check_year, 2), (check_month, 3, True), (check_year, 4),
+    )),
+]
+date_pattern, date_dispatch = compile_rules(date_rules)
+
+
+def check_date(value):
+    m = date_pattern.match(value)
+    if m is None:
+        return INVALID
+
+    for check, group, args in date_dispatch[m.lastgroup]:
+        result = check(m.group(group), *args)
+        if not result[0]:
+            return result
+
+    return VALID
+
+
+def validate_year(value):
+    """
+    Validate a year field value. Returns a (valid, problem) tuple.
+    """
+    result = year_cache.get(value)
+    if result is None:
+        result = check_year(strip_comments(value))
+        year_cache.set(value, result)
+    return result
 
 
-class DateValidator(Validator):
+def validate_date(value):
+    """
+    Validate a date field value. Returns a (valid, problem) tuple.
+    """
+    result = date_cache.get(value)
+    if result is None:
+        result = check_date(strip_comments(value))
+        date_cache.set(value, result)
+    return result
 
-    def check_year(self, value):
-        validator = YearValidator(value)
-        if not validator.valid:
-            return self.is_invalid(validator.problem)
-        return True
 
-    def check_numeric_month(self, value):
-        validator = NumericMonthValidator(value)
-        if not validator.valid:
-            return self.is_invalid(validator.problem)
-        return True
+def validate_month(value, include_seasons=False):
+    """
+    Validate a month name, or a season name if `include_seasons` is set.
+    Returns a (valid, problem) tuple.
+    """
+    return check_month(strip_comments(value), include_seasons)
 
-    def check_month(self, value, include_seasons):
-        validator = MonthValidator(value, include_seasons)
-        if not validator.valid:
-            return self.is_invalid(validator.problem)
-        return True
 
-    def check_day(self, value, allow_zero_prefix=True):
-        try:
-            ival = int(value)
-            if ival < 1 or ival > 31:
-                return self.is_invalid('Dag utenfor rekkevidde 1-31')
-            if not allow_zero_prefix and str(ival) != value:
-                return self.is_invalid('Dag har 0-prefiks')
-            return self.is_valid()
-        except ValueError:
-            return self.is_invalid('Klarte ikke å tolke dagverdien')
+def validate_numeric_month(value):
+    """
+    Validate a month number. Returns a (valid, problem) tuple.
+    """
+    return check_numeric_month(strip_comments(value))
 
-    def validate(self):
 
-        if re.match('^$', self.value):
-            # print 'Warning: empty date found'
-            return self.is_valid()  # empty
+class Validator(object):
+    """
+    Object wrapper around the validation functions. Subclasses set `check`
+    to the function to use.
+    """
 
-        if re.match('^udatert$', self.value):
-            return self.is_valid()
+    check = staticmethod(lambda value: VALID)
 
-        if re.match('^u\.d\.$', self.value):
-            return self.is_valid()
+    def __init__(self, value):
+        self.value = strip_comments(value)
+        self.valid, self.problem = self.check(value)
 
-        # 2014-01-01
-        m = re.match('^(\d{4})-(\d{2})-(\d{2})$', self.value)
-        if m:
-            return self.check_year(m.group(1)) and self.check_numeric_month(m.group(2)) and self.check_day(m.group(3))
 
-        # 2014, ca. 2014
-        m = re.match('^(ca?\. )?(\d{4})$', self.value)
-        if m:
-            return self.check_year(m.group(2))
+class YearValidator(Validator):
 
-        # 2014–2015
-        m = re.match('^(\d{4})–(\d{4})$', self.value)
-        if m:
-            return self.check_year(m.group(1)) and self.check_year(m.group(2))
+    check = staticmethod(validate_year)
 
-        # 1.1.2001
-        m = re.match('^(\d\d?)\.(\d\d?)\.(\d{4})$', self.value)
-        if m:
-            return self.check_day(m.group(1)) and self.check_numeric_month(m.group(2)) and self.check_year(m.group(3))
 
-        # 1. januar 2014
-        m = re.match('^(\d\d?)\. ([a-z]+) (\d{4})$', self.value)
-        if m:
-            q = self.check_day(m.group(1), False) and self.check_month(m.group(2), False) and self.check_year(m.group(3))
-            return q
+class MonthValidator(Validator):
 
-        # 1.–2. januar 2014
-        m = re.match('^(\d\d?)\.–(\d\d?)\. ([a-z]+) (\d{4})$', self.value)
-        if m:
-            return self.check_day(m.group(2), False) and self.check_day(m.group(2), False) and self.check_month(m.group(3), False) and self.check_year(m.group(4))
+    def __init__(self, value, include_seasons=False):
+        self.include_seasons = include_seasons
+        self.value = strip_comments(value)
+        self.valid, self.problem = check_month(self.value, include_seasons)
 
-        # 1. januar – 2. februar 2014
-        m = re.match('^(\d\d?)\. ([a-z]+) – (\d\d?)\. ([a-z]+) (\d{4})$', self.value)
-        if m:
-            return self.check_day(m.group(1), False) and self.check_month(m.group(2), False) and self.check_day(m.group(3), False) and self.check_month(m.group(4), False) and self.check_year(m.group(5))
 
-        # 1. januar 2014 – 1. februar 2015
-        m = re.match('^(\d\d?)\. ([a-z]+) (\d{4}) – (\d\d?)\. ([a-z]+) (\d{4})$', self.value)
-        if m:
-            return self.check_day(m.group(1), False) and self.check_month(m.group(2), False) and self.check_year(m.group(3)) and self.check_day(m.group(4), False) and self.check_month(m.group(5), False) and self.check_year(m.group(6))
+class NumericMonthValidator(Validator):
 
-        # januar 2014
-        m = re.match('^([A-Za-zøå]+) (\d{4})$', self.value)
-        if m:
-            return self.check_month(m.group(1), True) and self.check_year(m.group(2))
+    check = staticmethod(validate_numeric_month)
 
-        # januar–februar 2014
-        m = re.match('^([A-Za-zøå]+)–([a-z]+) (\d{4})$', self.value)
-        if m:
-            return self.check_month(m.group(1), True) and self.check_month(m.group(2), True) and self.check_year(m.group(3))
 
-        # januar 2014 – februar 2015
-        m = re.match('^([A-Za-zøå]+) (\d{4}) – ([a-zøå]+) (\d{4})$', self.value)
-        if m:
-            return self.check_month(m.group(1), True) and self.check_year(m.group(2)) and self.check_month(m.group(3), True) and self.check_year(m.group(4))
+class DateValidator(Validator):
 
-        return self.is_invalid()
+    check = staticmethod(validate_date)
 
 
 class VisitDateValidator(DateValidator):
@@ -300,16 +356,20 @@ class VisitDateValidator(DateValidator):
 
 
 def get_year_suggestion(val):
+    return call_logged(suggestion_cache, logger, ('year', val), get_year_suggestion_uncached, val)
+
+
+def get_year_suggestion_uncached(val):
 
     cleaned_val = pre_clean(val)
 
     # Ca. 2011 / c. 2011 / c2011
-    m = re.match('^ca?.? ?(\d{4})$', val, flags=re.I)
+    m = re.match(r'^ca?.? ?(\d{4})$', val, flags=re.I)
     if m:
         cleaned_val = 'ca. %s' % m.group(1)
 
     # Pre-clean
-    if YearValidator(cleaned_val).valid:
+    if validate_year(cleaned_val)[0]:
         return cleaned_val
 
 
@@ -323,25 +383,118 @@ def get_interactive_input(value):
     return new_value
 
 
-def pre_clean(val):
+pre_clean_chars = '.,' + string.whitespace
+
+pre_clean_comment = r'<!--.*?-->'
+pre_clean_start_date = r'\{\{Start date\|(?P<start_year>\d{4})\|(?P<start_month>\d{1,2})\|(?P<start_day>\d{1,2})(?:\|df=\w{2,3})?\}\}'
+pre_clean_atoms = '%s|%s' % (pre_clean_comment, re.sub(r'\(\?P<\w+>', '(?:', pre_clean_start_date))
+
+
+def pre_clean_unit(char_class):
+    # A character from char_class, or a whole comment or {{Start date}}. Those are removed or
+    # replaced by text without brackets or pipes, so a link or template can span them.
+    return '(?:%s|(?!%s)%s)' % (pre_clean_atoms, pre_clean_atoms, char_class)
+
+
+# The replacements pre_clean makes inside the value, as one alternation so
+# that the value is scanned once. Links and templates are replaced by one
+# of their groups, which is scanned in turn.
+pre_clean_re = re.compile('|'.join([
+    r'(?P<comment>%s)' % pre_clean_comment,  # strip comments
+    r'(?P<ndash>&ndash;)',  # bruk unicode
+    r'(?P<nbsp>&nbsp;)',  # bruk vanlig mellomrom
+    r'(?P<start_date>%s)' % pre_clean_start_date,
+    r'(?P<piped_link>\[\[(?P<link_target>%s+?)\|%s+?\]\])' % (pre_clean_unit(r'[^\]]'), pre_clean_unit(r'[^\]]')),  # strip wikilinks
+    r'(?P<link>\[\[(?P<link_text>%s+?)\]\])' % pre_clean_unit(r'[^|]'),  # strip wikilinks
+    r'(?P<template>\{(?!%s)\{%s+\|(?P<template_value>%s+)\}\})' % (pre_clean_atoms, pre_clean_unit(r'[^|}]'), pre_clean_unit(r'[^}]')),  # strip simple templates
+]))
+pre_clean_time_res = [
+    re.compile(r',? kl\.\s?\d\d?[:.]\d\d([:.]\d\d)?$'),  # fjern klokkeslett
+    re.compile(r',? \d\d?[:.]\d\d (?:[A-Z]{1,4})?$'),  # fjern klokkeslett, evt. med tidssone
+]
+pre_clean_brackets = dict((ord(c), None) for c in '()[]')
+pre_clean_cache = LRUCache(10000)
+
+
+def pre_clean_scan(val, pos, endpos, out, offsets):
+    # Append the cleaned form of val[pos:endpos] to out, and the position
+    # in val of each character appended to offsets, unless it is None.
+
+    def emit(text, start, end=None):
+        out.append(text)
+        if offsets is not None:
+            offsets.extend(range(start, end) if end is not None else [start] * len(text))
+
+    for m in pre_clean_re.finditer(val, pos, endpos):
+        if m.start() > pos:
+            emit(val[pos:m.start()], pos, m.start())
+        kind = m.lastgroup
+        if kind == 'ndash':
+            emit('–', m.start())
+        elif kind == 'nbsp':
+            emit(' ', m.start())
+        elif kind == 'start_date':
+            for group in ['start_year', 'start_month', 'start_day']:
+                if group != 'start_year':
+                    emit('-', m.start(group) - 1)
+                emit(m.group(group), m.start(group), m.end(group))
+        elif kind != 'comment':
+            group = {'piped_link': 'link_target', 'link': 'link_text', 'template': 'template_value'}[kind]
+            pre_clean_scan(val, m.start(group), m.end(group), out, offsets)
+        pos = m.end()
+
+    if endpos > pos:
+        emit(val[pos:endpos], pos, endpos)
+
+
+def pre_clean(val, with_offsets=False):
+    """
+    Remove markup and noise around a date value: comments, HTML entities,
+    links, simple templates, time of day, brackets and surrounding
+    punctuation.
+
+    If with_offsets is set, returns a tuple of the cleaned value and a list
+    with the position in val of each character in the cleaned value.
+    """
+    if with_offsets:
+        return pre_clean_uncached(val, True)
+    return call_logged(pre_clean_cache, logger, val, pre_clean_uncached, val)
+
+
+def pre_clean_uncached(val, with_offsets=False):
     # Pre-clean
-    orig_val = val
-    val = val.strip('.,' + string.whitespace)
-    val = re.sub('<!--.*?-->', '', val)  # strip comments
-    val = re.sub('&ndash;', '–', val)    # bruk unicode
-    val = re.sub('&nbsp;', ' ', val)     # bruk vanlig mellomrom
-    val = re.sub(r'\{\{Start date\|(\d{4})\|(\d{1,2})\|(\d{1,2})(?:\|df=\w{2,3})?\}\}', r'\1-\2-\3', val)    # strip wikilinks
-    val = re.sub(r'\[\[([^\]]+?)\|([^\]]+?)\]\]', r'\1', val)    # strip wikilinks
-    val = re.sub(r'\[\[([^|]+?)\]\]', r'\1', val)    # strip wikilinks
-    val = re.sub(r'\{\{([^|}]+)\|([^}]+)\}\}', r'\2', val)    # strip simple templates
-    val = re.sub(r',? kl\.\s?\d\d?[:.]\d\d([:.]\d\d)?$', '', val)  # fjern klokkeslett
-    val = re.sub(r',? \d\d?[:.]\d\d (?:[A-Z]{1,4})?$', '', val)  # fjern klokkeslett, evt. med tidssone
-    val = re.sub('[()\[\]]', '', val)
-    val = val.strip('.,' + string.whitespace)
-
-    if val != orig_val:
-        logger.debug('Pre-cleaned "%s" as "%s"', orig_val, val)
-    return val
+    stripped = val.strip(pre_clean_chars)
+    start = len(val) - len(val.lstrip(pre_clean_chars)) if stripped else 0
+    end = start + len(stripped)
+
+    out = []
+    offsets = [] if with_offsets else None
+    pre_clean_scan(val, start, end, out, offsets)
+    cleaned = ''.join(out)
+
+    for pattern in pre_clean_time_res:
+        m = pattern.search(cleaned)
+        if m:
+            cleaned = cleaned[:m.start()] + cleaned[m.end():]
+            if offsets is not None:
+                del offsets[m.start():m.end()]
+
+    if offsets is None:
+        cleaned = cleaned.translate(pre_clean_brackets).strip(pre_clean_chars)
+    else:
+        kept = [i for i, c in enumerate(cleaned) if ord(c) not in pre_clean_brackets]
+        cleaned = ''.join(cleaned[i] for i in kept)
+        offsets = [offsets[i] for i in kept]
+        lead = len(cleaned) - len(cleaned.lstrip(pre_clean_chars))
+        cleaned = cleaned.strip(pre_clean_chars)
+        offsets = offsets[lead:lead + len(cleaned)]
+
+    if cleaned != val:
+        logger.debug('Pre-cleaned "%s" as "%s"', val, cleaned)
+
+    if with_offsets:
+        return cleaned, offsets
+    return cleaned
 
 
 def parseYear(y, base='auto'):
@@ -358,8 +511,385 @@ def parseYear(y, base='auto'):
             return '%s%s' % (base, y)
 
 
+shape_letters_re = re.compile(r'[^\W\d_]+', re.UNICODE)
+shape_digits_re = re.compile(r'\d+', re.UNICODE)
+shape_cache = LRUCache(1000)
+
+
+def get_shape(val):
+    """
+    Return a cheap signature of the value, where each run of letters is
+    collapsed to "A" and each run of digits to "D", so that
+    "1. januar 2014" becomes "D. A D".
+    """
+    return shape_digits_re.sub('D', shape_letters_re.sub('A', val))
+
+
+class SuggestionRule(object):
+    """
+    A rule used by suggest_date. `pattern` is matched against the value, and
+    `shape` against the shape of the value (see get_shape). The shape pattern
+    must match the shape of every value that `pattern` can match, so that
+    rules can be skipped based on the shape alone.
+
+    `overlaps` names the earlier rules whose pattern can match some of the
+    same values. The rule is always tried after those, also when the rules
+    are reordered (see order_suggestion_rules). Rules that don't overlap
+    can be tried in any order, since at most one of them can match.
+
+    The rule counts how many values it was tried on, how many of them it
+    returned a suggestion for, and the time spent on them.
+    """
+
+    def __init__(self, name, pattern, shape, formatter, overlaps=()):
+        self.name = name
+        self.pattern = re.compile(pattern)
+        self.shape = re.compile(shape)
+        self.formatter = formatter
+        self.overlaps = tuple(overlaps)
+        self.attempts = 0
+        self.hits = 0
+        self.time = 0.
+
+    def apply(self, val):
+        start = time.time()
+        self.attempts += 1
+        m = self.pattern.match(val)
+        suggestion = self.formatter(m) if m else None
+        self.time += time.time() - start
+        if suggestion is not None:
+            self.hits += 1
+        return suggestion
+
+
+suggestion_rules = []
+
+
+def suggestion_rule(name, pattern, shape, overlaps=()):
+    # Decorator that registers a formatter as a suggest_date rule. Rules are tried in
+    # the order they are defined, and the first one to return a suggestion wins.
+    def decorator(formatter):
+        suggestion_rules.append(SuggestionRule(name, pattern, shape, formatter, overlaps))
+        return formatter
+    return decorator
+
+
+# Year only
+@suggestion_rule('year', r'^(\d{4})$', r'^D$')
+def suggest_year(m):
+    return '%s' % (m.group(1))
+
+
+# Year range
+# 2004-2005 : whitespace, tankestrek/bindestrek
+# 2004-05 -> 2004-2005
+@suggestion_rule('year_range', r'^(\d{4})\s?[-–]\s?(\d{2,4})$', r'^D\s?[-–]\s?D$')
+def suggest_year_range(m):
+    startYear = m.group(1)
+    endYear = parseYear(m.group(2), startYear[:2])
+    if endYear is not None:
+        diff = int(endYear[2:]) - int(startYear[2:])
+        if len(m.group(2)) == 4:
+            return '%s–%s' % (startYear, endYear)
+        elif diff > 0 and diff < 10:
+            return '%s–%s' % (startYear, endYear)
+
+
+# ISO-format:
+# - Fjern opptil to omkringliggende ikke-alfanumeriske tegn (\W matcher alt bortsett fra letters, 0-9 og underscore)
+# - Korriger tankestrek -> bindestrek
+@suggestion_rule('iso', r'^\W{0,2}(\d{4})[-–._](\d\d?)[-–._](\d\d?)\W{0,2}$', r'^\W{0,2}D[-–._]D[-–._]D\W{0,2}$')
+def suggest_iso(m):
+    return '%s-%02d-%02d' % (m.group(1), int(m.group(2)), int(m.group(3)))
+
+
+# YYYY-MM:
+# - Fjern opptil to omkringliggende ikke-alfanumeriske tegn
+# - Korriger tankestrek -> bindestrek
+# - Endre til måned år
+@suggestion_rule('year_month', r'^\W{0,2}(\d{4})[-–](\d\d?)\W{0,2}$', r'^\W{0,2}D[-–]D\W{0,2}$', overlaps=['year_range'])
+def suggest_year_month(m):
+    try:
+        return '%s %s' % (months[int(m.group(2)) - 1], m.group(1))
+    except IndexError:
+        pass
+
+
+# Norsk datoformat med to-sifret årstall (1.1.11 eller 01.01.11)
+@suggestion_rule('numeric_short_year', r'^(\d\d?)\.(\d\d?)\.(\d{2})$', r'^D\.D\.D$')
+def suggest_numeric_short_year(m):
+    year = parseYear(m.group(3))
+    if year:
+        if m.group(1).startswith('0') and len(m.group(2)) == 1:
+            # 05.5.2015 -> 5.5.2015
+            return '%s.%s.%s' % (m.group(1).lstrip('0'), m.group(2), year)
+        if m.group(2).startswith('0') and len(m.group(1)) == 1:
+            # 5.05.2015 -> 5.5.2015
+            return '%s.%s.%s' % (m.group(1), m.group(2).lstrip('0'), year)
+        return '%s.%s.%s' % (m.group(1), m.group(2), year)
+
+
+# 1/10-11 o.l.: Ikke 100 % entydig, men rimelig sannsynlig at d/m-yy på nowp
+@suggestion_rule('slash', r'^(\d\d?)\/(\d\d?)[- /]+(\d{2,4})$', r'^D/D[- /]+D$')
+def suggest_slash(m):
+    y = parseYear(m.group(3))
+    if y:
+        return '{}-{:02d}-{:02d}'.format(y, int(m.group(2)), int(m.group(1)))
+
+
+# 1. januar 2014 - 1. februar 2015
+@suggestion_rule('date_range',
+                 r'^(\d\d?)[.,]?\s?([a-zA-Z]+) (\d{4})\s?[-–]\s?(\d\d?)[.,]?\s?([a-zA-Z]+) (\d{4})$',
+                 r'^D[.,]?\s?A D\s?[-–]\s?D[.,]?\s?A D$')
+def suggest_date_range(m):
+    day1 = m.group(1).lstrip('0')
+    mnd1 = get_month(m.group(2).lower())
+    day2 = m.group(4).lstrip('0')
+    mnd2 = get_month(m.group(5).lower())
+    if mnd1 is not None and mnd2 is not None:
+        return '%s. %s %s – %s. %s %s' % (day1, mnd1, m.group(3), day2, mnd2, m.group(6))
+
+
+# 1. januar - 1. februar 2015
+@suggestion_rule('day_month_range',
+                 r'^(\d\d?)[.,]?\s?([a-zA-Z]+)\s?[-–]\s?(\d\d?)[.,]?\s?([a-zA-Z]+) (\d{4})$',
+                 r'^D[.,]?\s?A\s?[-–]\s?D[.,]?\s?A D$')
+def suggest_day_month_range(m):
+    day1 = m.group(1).lstrip('0')
+    mnd1 = get_month(m.group(2).lower())
+    day2 = m.group(3).lstrip('0')
+    mnd2 = get_month(m.group(4).lower())
+    if mnd1 is not None and mnd2 is not None:
+        return '%s. %s – %s. %s %s' % (day1, mnd1, day2, mnd2, m.group(5))
+
+
+# 1.-2. februar 2015 (punctuation errors)
+@suggestion_rule('day_range',
+                 r'^(\d\d?)[.,]?\s?[-–](\d\d?)[.,]?\s? ([a-zA-Z]+) (\d{4})$',
+                 r'^D[.,]?\s?[-–]D[.,]?\s? A D$')
+def suggest_day_range(m):
+    day1 = m.group(1).lstrip('0')
+    day2 = m.group(2).lstrip('0')
+    mnd = get_month(m.group(3).lower())
+    if mnd is not None:
+        return '%s.–%s. %s %s' % (day1, day2, mnd, m.group(4))
+
+
+# month/season year (January 2014, januar, 2014, høst 2014, [[januar 2014]], January 2014, ...) -> januar 2014
+# - The shape allows any character around, since [^a-zA-Z0-9] also matches non-ASCII letters and digits
+@suggestion_rule('month_year',
+                 r'^[^a-zA-Z0-9]{0,2}([a-zA-ZøåØÅ]+)[\., ]{1,2}(\d{4})[^a-zA-Z0-9]{0,2}$',
+                 r'^.{0,2}A[\., ]{1,2}D.{0,2}$')
+def suggest_month_year(m):
+    mnd = get_month_or_season(m.group(1).lower())
+    if mnd is not None:
+        return '%s %s' % (mnd, m.group(2))
+
+
+# month/season–month/season year (februar–mars 2010, vår–sommer 2012, Atumn–winter 2010)
+#  - Fix wrong separator (hyphen or /) as in "juni/juli" -> "juni-juli"
+@suggestion_rule('month_range',
+                 r'^([a-zA-ZøåØÅ]+)\s?[-–/]\s?([a-zA-ZøåØÅ]+) (\d{4})$',
+                 r'^A\s?[-–/]\s?A D$',
+                 overlaps=['month_year'])
+def suggest_month_range(m):
+    mnd1 = get_month_or_season(m.group(1).lower())
+    mnd2 = get_month_or_season(m.group(2).lower())
+    if mnd1 is not None and mnd2 is not None:
+        return '%s–%s %s' % (mnd1, mnd2, m.group(3))
+
+
+def get_shape_rules(shape):
+    """
+    Return the suggest_date rules that can match a value with the given shape,
+    in rule order. The result is cached per shape.
+    """
+    rules = shape_cache.get(shape)
+    if rules is None:
+        rules = [rule for rule in suggestion_rules if rule.shape.match(shape)]
+        shape_cache.set(shape, rules)
+    return rules
+
+
+def suggest_date(val, shape=None):
+    if shape is None:
+        shape = get_shape(val)
+
+    for rule in get_shape_rules(shape):
+        suggestion = rule.apply(val)
+        if suggestion is not None:
+            return suggestion
+
+
+def order_suggestion_rules(hits):
+    """
+    Reorder the suggest_date rules so that the rules with most hits, given as
+    a dict from rule name to count, are tried first. A rule is never moved
+    in front of the rules it overlaps, so suggestions stay the same. Rules
+    with the same count keep their relative order.
+    """
+    remaining = list(suggestion_rules)
+    ordered = []
+    while remaining:
+        placed = set(rule.name for rule in ordered)
+        ready = [rule for rule in remaining if placed.issuperset(rule.overlaps)]
+        rule = max(ready, key=lambda rule: hits.get(rule.name, 0))
+        ordered.append(rule)
+        remaining.remove(rule)
+    suggestion_rules[:] = ordered
+    shape_cache.clear()
+
+
+rule_hits = {}
+
+
+def load_rule_order(path):
+    """
+    Read the hit counts saved by save_rule_order from previous runs, if any,
+    and reorder the rules by them.
+    """
+    if not os.path.exists(path):
+        return
+    with codecs.open(path, 'r', 'utf8') as f:
+        rule_hits.update(json.load(f))
+    order_suggestion_rules(rule_hits)
+    logger.debug('Rule order: %s', ', '.join(rule.name for rule in suggestion_rules))
+
+
+def save_rule_order(path):
+    """
+    Add the hits from this run to the counts read by load_rule_order and save them.
+    """
+    hits = dict(rule_hits)
+    for rule in suggestion_rules:
+        hits[rule.name] = hits.get(rule.name, 0) + rule.hits
+    with codecs.open(path, 'w', 'utf8') as f:
+        json.dump(hits, f, indent=2, sort_keys=True)
+
+
+fuzzy_rules = []
+
+
+def fuzzy_rule(name, pattern):
+    # Decorator that registers a handler as a suggest_date_fuzzy rule. The handler is called
+    # with the groups of each match and yields zero or more suggestions.
+    def decorator(handler):
+        fuzzy_rules.append((name, pattern, handler, re.compile(pattern).groups))
+        return handler
+    return decorator
+
+
+# 'ukjent', 'dato ukjent', 'ukjent dato', 'ukjent publiseringsdato', ...
+@fuzzy_rule('undated', r'[a-zA-Z()]*\s?(undated|unknown|ukjent|udatert|u\.å\.?|n\.d\.?)\s?[a-zA-Z()]*')
+def fuzzy_undated(groups):
+    yield 'udatert'
+
+
+# ISO-datoer
+@fuzzy_rule('iso', r'(?<!\d)(\d{4})[-–._](\d\d?)[-–._](\d\d?)(?!\d)')
+def fuzzy_iso(groups):
+    yield '%s-%02d-%02d' % (groups[0], int(groups[1]), int(groups[2]))
+
+
+# Norsk datoformat (1.1.2011 eller 01.01.2011)
+# - Use negative lookbehind and lookahead to ensure digits to not precede or follow
+# - Rett bindestrek -> punktum
+@fuzzy_rule('numeric', r'(?<!\d)(\d\d?)[\s.-]+(\d\d?)[\s.-]+(\d{4})(?!\d)')
+def fuzzy_numeric(groups):
+    day, month, year = groups
+    if day.startswith('0') and len(month) == 1:
+        # 05.5.2015 -> 5.5.2015
+        yield '%s.%s.%s' % (day.lstrip('0'), month, year)
+    if month.startswith('0') and len(day) == 1:
+        # 5.05.2015 -> 5.5.2015
+        yield '%s.%s.%s' % (day, month.lstrip('0'), year)
+    else:
+        yield '%s.%s.%s' % (day, month, year)
+
+
+# January 1, 2014 -> 1. januar 2014
+# - [^\W\d_] matches unicode letters (\w minus digits and underscore)
+@fuzzy_rule('month_day_year', r'([^\W\d_]{3,})\.?\s?(\d\d?),\s?(\d{4})')
+def fuzzy_month_day_year(groups):
+    mnd = get_month(groups[0].lower())
+    day1 = groups[1].lstrip('0')
+    if mnd is not None:
+        yield '%s. %s %s' % (day1, mnd, groups[2])
+
+
+# 2014, January 1 -> 1. januar 2014
+@fuzzy_rule('year_month_day', r'(\d{4}),?\s?([^\W\d_]+)\s?(\d\d?)')
+def fuzzy_year_month_day(groups):
+    mnd = get_month(groups[1].lower())
+    day1 = groups[2].lstrip('0')
+    if mnd is not None:
+        yield '%s. %s %s' % (day1, mnd, groups[0])
+
+
+# Norsk datoformat (1. september 2014)
+# - Use negative lookbehind and lookahead to ensure digits to not precede or follow
+# - Punctuation errors: (1.januar2014, 1, januar 2014, 1 mars. 2010, 1 March 2010) -> 1. januar 2014
+# - Fikser månedsnavn med skrivefeil eller på engelsk eller svensk
+# - 10(th|st|rd)?( of)? -> 10.
+@fuzzy_rule('day_month_year', r'(?<!\d)(\d\d?)(?:th|st|rd|nd)?(?: of)?[\W]{0,3}([^\W\d_]{3,})(?: of)?[\W]{0,3}(\d{2}(?:\d{2})?)(?!\d)')
+def fuzzy_day_month_year(groups):
+    day1 = groups[0].lstrip('0')
+    mnd = get_month(groups[1])
+    year = parseYear(groups[2])
+    if mnd is not None and year is not None:
+        yield '%s. %s %s' % (day1, mnd, year)
+
+
+def compile_fuzzy_rules(rules):
+    """
+    Combine the fuzzy rules into a single pattern that matches, with zero
+    width, at each position where at least one rule matches. Each rule is in
+    its own optional lookahead group, so one match tells which of the rules
+    match from that position. All rules are case insensitive.
+    """
+    gate = '(?=%s)' % '|'.join(pattern for name, pattern, handler, groups in rules)
+    lookaheads = ''.join('(?:(?=(?P<%s>%s)))?' % (name, pattern) for name, pattern, handler, groups in rules)
+    return re.compile(gate + lookaheads, re.IGNORECASE | re.UNICODE)
+
+
+fuzzy_re = compile_fuzzy_rules(fuzzy_rules)
+
+
+def suggest_date_fuzzy(val):
+    """
+    Find date-like fragments anywhere in the value. Returns the suggestions
+    found, but stops as soon as there are two, since the value is then
+    ambiguous anyway. A fragment found twice, even with the same suggestion,
+    counts as two.
+
+    The value is scanned once for all rules. For each rule, the matches are
+    the same as re.finditer with that rule would give, since a match is only
+    used if it starts after the end of the previous match for the same rule.
+    """
+    suggestions = []
+    ends = {}
+    for m in fuzzy_re.finditer(val):
+        groups = m.groups()
+        for name, pattern, handler, ngroups in fuzzy_rules:
+            start = m.start(name)
+            if start == -1 or start < ends.get(name, 0):
+                continue
+            ends[name] = m.end(name)
+            offset = fuzzy_re.groupindex[name]
+            for suggestion in handler(groups[offset:offset + ngroups]):
+                suggestions.append(suggestion)
+                if len(suggestions) > 1:
+                    return suggestions
+    return suggestions
+
+
 def get_date_suggestion(val, field_name, interactive_mode=False):
-    suggestion = get_date_suggestion_inner(val, field_name, interactive_mode)
+    key = ('date', val, field_name, interactive_mode)
+    return call_logged(suggestion_cache, logger, key, get_date_suggestion_uncached, val, field_name, interactive_mode)
+
+
+def get_date_suggestion_uncached(val, field_name, interactive_mode=False):
+    suggestion = get_date_suggestion_stored(val, field_name, interactive_mode)
     if suggestion:
         # Preserve simple comments
         m = re.match(r'(.*)(<!--.*?-->)\s*', val)
@@ -369,177 +899,35 @@ def get_date_suggestion(val, field_name, interactive_mode=False):
         return suggestion
 
 
-def get_date_suggestion_inner(val, field_name, interactive_mode=False):
+def get_date_suggestion_stored(val, field_name, interactive_mode=False):
     """
-    Involving just one field/value
+    Look the value up in the persistent suggestion store, if one is open,
+    before running the rules. New suggestions are added to the store.
+    Values corrected by hand in interactive mode are not stored.
     """
+    if suggestion_store is None or interactive_mode:
+        return get_date_suggestion_inner(val, field_name, interactive_mode)
 
-    def suggest_date(val):
-
-        # Year only
-        m = re.match('^(\d{4})$', val)
-        if m:
-            return '%s' % (m.group(1))
-
-        # Year range
-        # 2004-2005 : whitespace, tankestrek/bindestrek
-        # 2004-05 -> 2004-2005
-        m = re.match('^(\d{4})\s?[-–]\s?(\d{2,4})$', val)
-        if m:
-            startYear = m.group(1)
-            endYear = parseYear(m.group(2), startYear[:2])
-            if endYear is not None:
-                diff = int(endYear[2:]) - int(startYear[2:])
-                if len(m.group(2)) == 4:
-                    return '%s–%s' % (startYear, endYear)
-                elif diff > 0 and diff < 10:
-                    return '%s–%s' % (startYear, endYear)
-
-        # ISO-format:
-        # - Fjern opptil to omkringliggende ikke-alfanumeriske tegn (\W matcher alt bortsett fra letters, 0-9 og underscore)
-        # - Korriger tankestrek -> bindestrek
-        m = re.match('^\W{0,2}(\d{4})[-–._](\d\d?)[-–._](\d\d?)\W{0,2}$', val)
-        if m:
-            return '%s-%02d-%02d' % (m.group(1), int(m.group(2)), int(m.group(3)))
-
-        # YYYY-MM:
-        # - Fjern opptil to omkringliggende ikke-alfanumeriske tegn
-        # - Korriger tankestrek -> bindestrek
-        # - Endre til måned år
-        m = re.match('^\W{0,2}(\d{4})[-–](\d\d?)\W{0,2}$', val)
-        if m:
-            try:
-                return '%s %s' % (months[int(m.group(2)) - 1], m.group(1))
-            except IndexError:
-                pass
+    suggestion = suggestion_store.get(val)
+    if suggestion is not None:
+        logger.info('%s:"%s" can be changed to "%s"', field_name, val, suggestion)
+        return suggestion
 
-        # Norsk datoformat med to-sifret årstall (1.1.11 eller 01.01.11)
-        m = re.match('^(\d\d?)\.(\d\d?)\.(\d{2})$', val)
-        if m:
-            year = parseYear(m.group(3))
-            if year:
-                if m.group(1).startswith('0') and len(m.group(2)) == 1:
-                    # 05.5.2015 -> 5.5.2015
-                    return '%s.%s.%s' % (m.group(1).lstrip('0'), m.group(2), year)
-                if m.group(2).startswith('0') and len(m.group(1)) == 1:
-                    # 5.05.2015 -> 5.5.2015
-                    return '%s.%s.%s' % (m.group(1), m.group(2).lstrip('0'), year)
-                return '%s.%s.%s' % (m.group(1), m.group(2), year)
-
-        # 1/10-11 o.l.: Ikke 100 % entydig, men rimelig sannsynlig at d/m-yy på nowp
-        m = re.match('^(\d\d?)\/(\d\d?)[- /]+(\d{2,4})$', val)
-        if m:
-            y = parseYear(m.group(3))
-            if y:
-                return '{}-{:02d}-{:02d}'.format(y, int(m.group(2)), int(m.group(1)))
+    suggestion = get_date_suggestion_inner(val, field_name, interactive_mode)
+    if suggestion is not None and suggestion != val:
+        suggestion_store.set(val, suggestion)
+    return suggestion
 
-        # 1. januar 2014 - 1. februar 2015
-        m = re.match('^(\d\d?)[.,]?\s?([a-zA-Z]+) (\d{4})\s?[-–]\s?(\d\d?)[.,]?\s?([a-zA-Z]+) (\d{4})$', val)
-        if m:
-            day1 = m.group(1).lstrip('0')
-            mnd1 = get_month(m.group(2).lower())
-            day2 = m.group(4).lstrip('0')
-            mnd2 = get_month(m.group(5).lower())
-            if mnd1 is not None and mnd2 is not None:
-                return '%s. %s %s – %s. %s %s' % (day1, mnd1, m.group(3), day2, mnd2, m.group(6))
-
-        # 1. januar - 1. februar 2015
-        m = re.match('^(\d\d?)[.,]?\s?([a-zA-Z]+)\s?[-–]\s?(\d\d?)[.,]?\s?([a-zA-Z]+) (\d{4})$', val)
-        if m:
-            day1 = m.group(1).lstrip('0')
-            mnd1 = get_month(m.group(2).lower())
-            day2 = m.group(3).lstrip('0')
-            mnd2 = get_month(m.group(4).lower())
-            if mnd1 is not None and mnd2 is not None:
-                return '%s. %s – %s. %s %s' % (day1, mnd1, day2, mnd2, m.group(5))
-
-        # 1.-2. februar 2015 (punctuation errors)
-        m = re.match('^(\d\d?)[.,]?\s?[-–](\d\d?)[.,]?\s? ([a-zA-Z]+) (\d{4})$', val)
-        if m:
-            day1 = m.group(1).lstrip('0')
-            day2 = m.group(2).lstrip('0')
-            mnd = get_month(m.group(3).lower())
-            if mnd is not None:
-                return '%s.–%s. %s %s' % (day1, day2, mnd, m.group(4))
-
-        # month/season year (January 2014, januar, 2014, høst 2014, [[januar 2014]], January 2014, ...) -> januar 2014
-        m = re.match('^[^a-zA-Z0-9]{0,2}([a-zA-ZøåØÅ]+)[\., ]{1,2}(\d{4})[^a-zA-Z0-9]{0,2}$', val)
-        if m:
-            mnd = get_month_or_season(m.group(1).lower())
-            if mnd is not None:
-                return '%s %s' % (mnd, m.group(2))
 
-        # month/season–month/season year (februar–mars 2010, vår–sommer 2012, Atumn–winter 2010)
-        #  - Fix wrong separator (hyphen or /) as in "juni/juli" -> "juni-juli"
-        m = re.match('^([a-zA-ZøåØÅ]+)\s?[-–/]\s?([a-zA-ZøåØÅ]+) (\d{4})$', val)
-        if m:
-            mnd1 = get_month_or_season(m.group(1).lower())
-            mnd2 = get_month_or_season(m.group(2).lower())
-            if mnd1 is not None and mnd2 is not None:
-                return '%s–%s %s' % (mnd1, mnd2, m.group(3))
-
-    def suggest_date_fuzzy(val):
-        suggestions = []
-
-        # 'ukjent', 'dato ukjent', 'ukjent dato', 'ukjent publiseringsdato', ...
-        for m in re.finditer('[a-zA-Z()]*\s?(undated|unknown|ukjent|udatert|u\.å\.?|n\.d\.?)\s?[a-zA-Z()]*', val, flags=re.I):
-            suggestions.append('udatert')
-
-        # ISO-datoer
-        for m in re.finditer('(?<!\d)(\d{4})[-–._](\d\d?)[-–._](\d\d?)(?!\d)', val):
-            suggestions.append('%s-%02d-%02d' % (m.group(1), int(m.group(2)), int(m.group(3))))
-
-        # Norsk datoformat (1.1.2011 eller 01.01.2011)
-        # - Use negative lookbehind and lookahead to ensure digits to not precede or follow
-        # - Rett bindestrek -> punktum
-        for m in re.finditer('(?<!\d)(\d\d?)[\s.-]+(\d\d?)[\s.-]+(\d{4})(?!\d)', val):
-            if m.group(1).startswith('0') and len(m.group(2)) == 1:
-                # 05.5.2015 -> 5.5.2015
-                suggestions.append('%s.%s.%s' % (m.group(1).lstrip('0'), m.group(2), m.group(3)))
-            if m.group(2).startswith('0') and len(m.group(1)) == 1:
-                # 5.05.2015 -> 5.5.2015
-                suggestions.append('%s.%s.%s' % (m.group(1), m.group(2).lstrip('0'), m.group(3)))
-            else:
-                suggestions.append('%s.%s.%s' % (m.group(1), m.group(2), m.group(3)))
-
-        # January 1, 2014 -> 1. januar 2014
-        # - [^\W\d_] matches unicode letters (\w minus digits and underscore)
-        for m in re.finditer('([^\W\d_]{3,})\.?\s?(\d\d?),\s?(\d{4})', val, re.UNICODE):
-            mnd = get_month(m.group(1).lower())
-            day1 = m.group(2).lstrip('0')
-            if mnd is not None:
-                suggestions.append('%s. %s %s' % (day1, mnd, m.group(3)))
-
-        # 2014, January 1 -> 1. januar 2014
-        for m in re.finditer('(\d{4}),?\s?([^\W\d_]+)\s?(\d\d?)', val, re.UNICODE):
-            mnd = get_month(m.group(2).lower())
-            day1 = m.group(3).lstrip('0')
-            if mnd is not None:
-                suggestions.append('%s. %s %s' % (day1, mnd, m.group(1)))
-
-        # Norsk datoformat (1. september 2014)
-        # - Use negative lookbehind and lookahead to ensure digits to not precede or follow
-        # - Punctuation errors: (1.januar2014, 1, januar 2014, 1 mars. 2010, 1 March 2010) -> 1. januar 2014
-        # - Fikser månedsnavn med skrivefeil eller på engelsk eller svensk
-        # - 10(th|st|rd)?( of)? -> 10.
-        # p_word = '[^ ]*?'
-        # p_word_delim = '[ :.,;]'
-        # p_before = '^' + ('(?:%s%s)?' % (p_word, p_word_delim))   # match max one words
-        # p_after = ('(?:%s%s)?' % (p_word_delim, p_word)) *2 + '$'  # match max two words
-        pattern = '(?<!\d)(\d\d?)(?:th|st|rd|nd)?(?: of)?[\W]{0,3}([^\W\d_]{3,})(?: of)?[\W]{0,3}(\d{2}(?:\d{2})?)(?!\d)'
-        for m in re.finditer(pattern, val, flags=re.IGNORECASE | re.UNICODE):
-            day1 = m.group(1).lstrip('0')
-            mnd = get_month(m.group(2))
-            year = parseYear(m.group(3))
-            if mnd is not None and year is not None:
-                suggestions.append('%s. %s %s' % (day1, mnd, year))
-
-        return suggestions
+def get_date_suggestion_inner(val, field_name, interactive_mode=False):
+    """
+    Involving just one field/value
+    """
 
     cleaned_val = pre_clean(val)
 
     # Check if pre-cleaned date is valid
-    if DateValidator(cleaned_val).valid:
+    if validate_date(cleaned_val)[0]:
         if cleaned_val == val:
             logger.debug('%s:"%s" seems to be valid as-is', field_name, val)
         else:
@@ -567,16 +955,175 @@ def get_date_suggestion_inner(val, field_name, interactive_mode=False):
             dt = dts[0]
 
     # Check that suggested date is actually valid
-    dv = DateValidator(dt)
-    if not dv.valid:
-        logger.warning('%s:"%s" produced an invalid suggestion "%s": %s', field_name, val, dt, dv.problem)
+    valid, problem = validate_date(dt)
+    if not valid:
+        logger.warning('%s:"%s" produced an invalid suggestion "%s": %s', field_name, val, dt, problem)
         return None
 
     logger.info('%s:"%s" can be changed to "%s"', field_name, val, dt)
     return dt
 
 
+def get_ruleset_version():
+    """
+    Return a hash of the code and word lists that date suggestions are
+    derived from, including the validation of the suggestions and the
+    current year, which years are checked against. Stored suggestions are
+    only used for the same version.
+    """
+    with codecs.open(lexicon_data_path, 'r', 'utf8') as f:
+        parts = [f.read()]
+    parts.append(' '.join(sorted(month_stopwords)))
+    parts.append(str(current_year))
+    parts.extend(rule.pattern.pattern for rule in suggestion_rules)
+    parts.extend(pattern.pattern for pattern in [pre_clean_re, fuzzy_re, date_pattern, comment_re] + pre_clean_time_res + year_patterns)
+    parts.extend('%s %r' % (name, [(check[0].__name__,) + tuple(check[1:]) for check in checks])
+                 for name, rule, checks in date_rules)
+    sources = [pre_clean_uncached, pre_clean_scan, parseYear, get_month, get_month_or_season, suggest_date, suggest_date_fuzzy, get_date_suggestion_inner,
+               get_year_suggestion_uncached, inspect.getmodule(correct), inspect.getmodule(lexicon.__class__),
+               strip_comments, check_date, check_year, check_month, check_numeric_month, check_day]
+    sources.extend(rule.formatter for rule in suggestion_rules)
+    sources.extend(handler for name, pattern, handler, groups in fuzzy_rules)
+    for obj in sources:
+        try:
+            parts.append(inspect.getsource(obj))
+        except (IOError, TypeError):
+            parts.append(obj.__name__)
+    return hashlib.sha1('\n'.join(parts).encode('utf8')).hexdigest()
+
+
+def open_suggestion_store(path, history_file='modified-simple.txt'):
+    """
+    Open the persistent suggestion store and use it for get_date_suggestion.
+    The first time the store is opened with a new rule-set version, it is
+    seeded with the values from the history of saved changes.
+    """
+    global suggestion_store
+    ruleset = get_ruleset_version()
+    suggestion_store = SuggestionStore(path, ruleset)
+
+    if os.path.exists(history_file) and suggestion_store.get_meta('seeded') != ruleset:
+        seed_suggestion_store(history_file)
+        suggestion_store.set_meta('seeded', ruleset)
+
+    return suggestion_store
+
+
+def seed_suggestion_store(history_file):
+    """
+    Run the rules on each old value in the history file (page, old value and
+    new value, tab separated), which adds the results to the store. The history
+    also holds year and combined date/year changes that the rules don't give
+    for the value alone, so the historical new values are only counted, not stored.
+    """
+    history = {}
+    with codecs.open(history_file, 'r', 'utf8') as f:
+        for line in f:
+            line = line.rstrip('\n').split('\t')
+            if len(line) == 3:
+                history[line[1]] = line[2]
+
+    level = logger.level
+    logger.setLevel(logging.WARNING)
+    try:
+        matched = sum(1 for old, new in history.items() if get_date_suggestion_uncached(old, '(seed)') == new)
+    finally:
+        logger.setLevel(level)
+        # The messages for the results cached while seeding were not logged, so they are
+        # not stored with the results either, and cache hits would log nothing
+        for cache in [suggestion_cache, pre_clean_cache, month_misses, month_or_season_misses]:
+            cache.clear()
+    suggestion_store.commit()
+
+    logger.info('Seeded suggestion store from %s: %d of %d values gave the same result', history_file, matched, len(history))
+
+
+citation_templates = ['Kilde www', 'Kilde bok', 'Kilde artikkel', 'Kilde avhandling', 'Kilde avis', 'Cite web', 'Citeweb', 'Cite news', 'Cite journal', 'Cite book', 'Tidningsref', 'Webbref', 'Bokref']
+
+
+class TemplateSnapshot(object):
+    """
+    An immutable copy of the name and the parameters of a template, with the
+    parameters as a tuple of (key, value) pairs in template order. Unlike
+    mwtemplates templates, snapshots can be pickled and sent to other
+    processes.
+    """
+
+    __slots__ = ('name', 'params')
+
+    def __init__(self, name, params):
+        object.__setattr__(self, 'name', name)
+        object.__setattr__(self, 'params', tuple((key, value) for key, value in params))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('TemplateSnapshot is immutable')
+
+    def __reduce__(self):
+        return (TemplateSnapshot, (self.name, self.params))
+
+    def __eq__(self, other):
+        return isinstance(other, TemplateSnapshot) and (self.name, self.params) == (other.name, other.params)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.name, self.params))
+
+    def __repr__(self):
+        return 'TemplateSnapshot(%r, %r)' % (self.name, self.params)
+
+    @classmethod
+    def from_template(cls, tpl):
+        return cls(tpl.key, [(p.key, p.value) for p in tpl.parameters])
+
+
+class SnapshotParam(object):
+    # A parameter of a snapshot while it is being checked. `index` is the position in the
+    # snapshot, or None for parameters added by the checks.
+
+    __slots__ = ('index', 'key', 'value', 'removed')
+
+    def __init__(self, index, key, value):
+        self.index = index
+        self.key = key
+        self.value = value
+        self.removed = False
+
+
+def apply_edits(tpl, edits):
+    """
+    Apply the edits made by Template to a mwtemplates template. Each edit is
+    one of:
+
+    - ('edit', index, value): change the value of the parameter at that
+      position in the snapshot
+    - ('set', key, value): change the value of the first parameter with that
+      key, or add the parameter if there is none
+    - ('remove', key): remove the first parameter with that key
+    """
+    params = list(tpl.parameters)
+    for edit in edits:
+        if edit[0] == 'edit':
+            params[edit[1]].value = edit[2]
+        elif edit[0] == 'set':
+            tpl.parameters[edit[1]] = edit[2]
+        elif edit[0] == 'remove':
+            del tpl.parameters[edit[1]]
+
+
 class Template:
+    """
+    Checks the date fields of a citation template. `tpl` is either a
+    TemplateSnapshot or a mwtemplates template. The changes are collected as
+    a list of edits in `edits` (see apply_edits), and are also applied if
+    `tpl` is a mwtemplates template.
+    """
+
+    date_keys = ['dato', 'utgivelsesdato', 'date', 'laydate', 'arkivdato', 'archivedate', 'arkivdatum', 'besøksdato', 'accessdate', 'hämtdatum']
+    year_keys = ['utgivelsesår', 'år', 'year']
+    month_keys = ['måned', 'month']
+    day_keys = ['dag', 'day']
 
     def __init__(self, tpl, interactive_mode):
 
@@ -585,62 +1132,97 @@ class Template:
         self.mnd = []
         self.aar = []
         self.tpl = tpl
+        if isinstance(tpl, TemplateSnapshot):
+            self.snapshot = tpl
+        else:
+            self.snapshot = TemplateSnapshot.from_template(tpl)
+        self.params = [SnapshotParam(index, key, value) for index, (key, value) in enumerate(self.snapshot.params)]
+        self.edits = []
 
         self.checked = 0
         self.modified = []
         self.unresolved = []
 
-        for p in tpl.parameters:
-            if p.key in ['dato', 'utgivelsesdato', 'date', 'laydate', 'arkivdato', 'archivedate', 'arkivdatum', 'besøksdato', 'accessdate', 'hämtdatum']:
+        for p in self.params:
+            if p.key in self.date_keys:
                 self.dato.append(p)
-            if p.key in ['utgivelsesår', 'år', 'year']:
+            if p.key in self.year_keys:
                 self.aar.append(p)
-            if p.key in ['måned', 'month']:
+            if p.key in self.month_keys:
                 self.mnd.append(p)
-            if p.key in ['dag', 'day']:
+            if p.key in self.day_keys:
                 self.dag.append(p)
 
         for p in self.aar:
 
             self.checked += 1
 
-            validator = YearValidator(p.value)
+            valid, problem = validate_year(p.value)
 
-            if validator.valid:
+            if valid:
                 continue
 
             suggest = get_year_suggestion(p.value)
             if suggest:
                 self.modified.append({'key': p.key, 'old': p.value, 'new': suggest, 'complex': False})
-                p.value = suggest
+                self.edit_param(p, suggest)
                 continue
 
             if not self.complex_replacements_year(p):
-                self.unresolved.append({'key': p.key, 'value': p.value, 'problem': validator.problem})
+                self.unresolved.append({'key': p.key, 'value': p.value, 'problem': problem})
 
         for p in self.dato:
 
             self.checked += 1
 
-            validator = DateValidator(p.value)
+            valid, problem = validate_date(p.value)
 
-            if validator.valid:
+            if valid:
                 continue
 
             suggest = get_date_suggestion(p.value, p.key, interactive_mode)
             if suggest:
                 self.modified.append({'key': p.key, 'old': p.value, 'new': suggest, 'complex': False})
-                p.value = suggest
+                self.edit_param(p, suggest)
                 continue
 
             suggest2 = get_year_suggestion(p.value)
             if suggest2:
                 self.modified.append({'key': p.key, 'old': p.value, 'new': suggest2, 'complex': False})
-                p.value = suggest2
+                self.edit_param(p, suggest2)
                 continue
 
             if not self.complex_replacements(p):
-                self.unresolved.append({'key': p.key, 'value': p.value, 'problem': validator.problem})
+                self.unresolved.append({'key': p.key, 'value': p.value, 'problem': problem})
+
+        if not isinstance(tpl, TemplateSnapshot):
+            apply_edits(tpl, self.edits)
+
+    def find_param(self, key):
+        for p in self.params:
+            if p.key == key and not p.removed:
+                return p
+
+    def edit_param(self, p, value):
+        p.value = value
+        if p.index is None:
+            self.edits.append(('set', p.key, value))
+        else:
+            self.edits.append(('edit', p.index, value))
+
+    def set_param(self, key, value):
+        p = self.find_param(key)
+        if p is None:
+            self.params.append(SnapshotParam(None, key, value))
+        else:
+            p.value = value
+        self.edits.append(('set', key, value))
+
+    def remove_param(self, key):
+        p = self.find_param(key)
+        if p is not None:
+            p.removed = True
+            self.edits.append(('remove', key))
 
     def complex_replacements(self, p):
         """
@@ -658,8 +1240,8 @@ class Template:
             if suggest:
                 logger.info('%s:"%s" can be changed to "%s" and %s removed', p.key, p.value, suggest, self.aar[0].key)
                 self.modified.append({'key': p.key, 'old': p.value, 'new': suggest, 'complex': True})
-                p.value = suggest
-                del self.tpl.parameters[self.aar[0].key]
+                self.edit_param(p, suggest)
+                self.remove_param(self.aar[0].key)
                 return True
 
             return False
@@ -677,7 +1259,7 @@ class Template:
             return False
 
         suggest = None
-        if DateValidator(p.value).valid:
+        if validate_date(p.value)[0]:
             # The value is not a valid year field value, but is a valid date field value
             suggest = p.value
         else:
@@ -691,10 +1273,10 @@ class Template:
         # Add the value to either the {date} field if English template or {dato} otherwise
         param = 'date' if p.key == 'year' else 'dato'
         self.modified.append({'key': param, 'old': p.value, 'new': suggest, 'complex': True})
-        self.tpl.parameters[param] = suggest
+        self.set_param(param, suggest)
 
         # Remove the original {year} field
-        del self.tpl.parameters[p.key]
+        self.remove_param(p.key)
 
         return True
 
@@ -704,62 +1286,175 @@ class Page:
     def format_entry(self, s):
         return "Endret '%(key)s' fra '%(old)s' til '%(new)s'" % s
 
-    def __init__(self, page, interactive_mode):
+    @staticmethod
+    def prescan(txt):
+        """
+        Find the date and year values in the citation templates without
+        parsing the page. Returns the number of values found if they are
+        all valid, or None if at least one of them is not.
+        """
+        checked = 0
+        for tpl in find_templates(txt, citation_templates):
+            for p in tpl.params:
+                if p.key in Template.year_keys:
+                    valid = validate_year(p.value)[0]
+                elif p.key in Template.date_keys:
+                    valid = validate_date(p.value)[0]
+                else:
+                    continue
+                if not valid:
+                    return None
+                checked += 1
+        return checked
+
+    def save_section(self, page, txt, edits, summary):
+        """
+        Save only the section that holds all the edits, if there is one.
+        Returns the API response, or None if the whole page must be saved.
+        """
+        section = find_edit_section(txt, edits)
+        if section is None or section[0] == 0:
+            return None
+        number, start, end = section
+        old = txt[start:end]
+
+        # The edit API strips trailing whitespace from the section text and separates it
+        # from the next section with a blank line
+        if end != len(txt) and old[len(old.rstrip()):] != '\n\n':
+            return None
+
+        # Check that the server agrees on where the section is. Fetching the section sets the
+        # timestamps used to detect edit conflicts to those of the latest revision, so they are
+        # set back to those of the revision the edits were made to. Otherwise, if the page has
+        # been edited since, saving the whole page would overwrite that edit.
+        last_rev_time, edit_time = page.last_rev_time, page.edit_time
+        try:
+            current = page.text(section=number, cache=False)
+        finally:
+            page.last_rev_time, page.edit_time = last_rev_time, edit_time
+        if current.rstrip() != old.rstrip():
+            logger.warning('Section %d is not as expected, saving the whole page', number)
+            return None
+
+        new = splice(old, [(edit_start - start, edit_end - start, replacement) for edit_start, edit_end, replacement in edits])
+        logger.debug('Saving section %d (%d of %d characters)', number, len(new), len(txt))
+        return page.save(new.rstrip(), summary=summary, section=number)
+
+    def write(self, page, txt, edits, summary):
+        res = None
+        if self.section_saves:
+            res = self.save_section(page, txt, edits, summary)
+        if res is None:
+            res = page.save(splice(txt, edits), summary=summary)
+        return res
+
+    def __init__(self, page, interactive_mode, section_saves=False, save=True):
+        """
+        Check the page, and save it if any dates were fixed, unless `save` is
+        False, in which case save() can be called later.
+        """
 
         logger.info('Checking page: %s', page.name)
 
+        self.page = page
+        self.section_saves = section_saves
         self.checked = 0
         self.modified = []
         self.unresolved = []
+        self.edits = []
+        self.newrevid = None
 
         # te = page.text()
-        txt = page.text()
+        txt = self.txt = page.text()
 
         # Due to <https://github.com/danmichaelo/mwtemplates/issues/3>
         if re.search('<nowiki ?/>', txt, re.I) is not None:
             return
 
-        te = TemplateEditor(txt)
+        # Most of the time is spent parsing the page, so skip that if there's nothing to fix
+        checked = self.prescan(txt)
+        if checked is not None:
+            logger.debug('All %d date values are valid', checked)
+            self.checked = checked
+            return
 
-        modified = False
-        for k, v in te.templates.iteritems():
-            if k in ['Kilde www', 'Kilde bok', 'Kilde artikkel', 'Kilde avhandling', 'Kilde avis', 'Cite web', 'Citeweb', 'Cite news', 'Cite journal', 'Cite book', 'Tidningsref', 'Webbref', 'Bokref']:
-                for tpl in v:
-                    t = Template(tpl, interactive_mode)
-                    self.checked += t.checked
-                    self.modified.extend(t.modified)
-                    self.unresolved.extend(t.unresolved)
+        # Parse only the citation templates, so that the time and memory used grows with the
+        # number of citations, not the size of the page. The templates nested in them are
+        # parsed along with them.
+        for span in find_templates(txt, citation_templates, nested=False):
+            te = TemplateEditor(span.wikitext)
+            modified = len(self.modified)
+            for k, v in te.templates.iteritems():
+                if k in citation_templates:
+                    for tpl in v:
+                        t = Template(tpl, interactive_mode)
+                        self.checked += t.checked
+                        self.modified.extend(t.modified)
+                        self.unresolved.extend(t.unresolved)
+            if len(self.modified) != modified:
+                # Change only the parameter values that were modified, so that nothing else
+                # in the page is touched
+                self.edits.extend(minimal_edits(txt, span.start, span.end, te.wikitext()))
 
         for u in self.unresolved:
             u['page'] = page.name
 
-        if len(self.modified) != 0:
-            if len(self.modified) == 1:
-                summary = 'CS1-kompatible datoer: %s' % (self.format_entry(self.modified[0]))
-            elif len(self.modified) == 2:
-                summary = 'CS1-kompatible datoer: %s, %s' % (self.format_entry(self.modified[0]), self.format_entry(self.modified[1]))
-            else:
-                summary = 'CS1-kompatible datoer: Fikset %d datoer' % (len(self.modified))
+        if save:
+            self.save()
+
+    def save(self):
+        """
+        Save the fixed dates, if there are any.
+        """
+        if len(self.modified) == 0:
+            return
+
+        page = self.page
+        txt = self.txt
+        edits = self.edits
+
+        if len(self.modified) == 1:
+            summary = 'CS1-kompatible datoer: %s' % (self.format_entry(self.modified[0]))
+        elif len(self.modified) == 2:
+            summary = 'CS1-kompatible datoer: %s, %s' % (self.format_entry(self.modified[0]), self.format_entry(self.modified[1]))
+        else:
+            summary = 'CS1-kompatible datoer: Fikset %d datoer' % (len(self.modified))
+
+        logger.info('Saving %d fixed date(s) on %s', len(self.modified), page.name)
+
+        try:
+            res = edit_scheduler.run(self.write, page, txt, edits, summary)
+        except ProtectedPageError:
+            logger.error('ERROR: Page protected, could not save')
+            return
 
-            logger.info('Saving %d fixed date(s)', len(self.modified))
-            time.sleep(1)
+        if res.get('newrevid') is not None:
+            self.newrevid = res['newrevid']
+            with codecs.open('modified.txt', 'a', 'utf8') as f:
+                for x in self.modified:
+                    ti = quote(page.name.replace(' ', '_').encode('utf8'))
+                    difflink = '//no.wikipedia.org/w/index.php?title=%s&diff=%s&oldid=%s' % (ti, res['newrevid'], res['oldrevid'])
+                    f.write('| [[%s]] ([%s diff]) || Endret %s fra %s til %s || %s\n|-\n' % (page.name, difflink, x['key'], x['old'], x['new'], 'kompleks' if x['complex'] else ''))
 
-            try:
-                res = page.save(te.wikitext(), summary=summary)
-            except mwclient.errors.ProtectedPageError:
-                logger.error('ERROR: Page protected, could not save')
+            with codecs.open('modified-simple.txt', 'a', 'utf8') as f:
+                for x in self.modified:
+                    ti = quote(page.name.replace(' ', '_').encode('utf8'))
+                    f.write('%s\t%s\t%s\n' % (page.name, x['old'], x['new']))
 
-            if res.get('newrevid') is not None:
-                with codecs.open('modified.txt', 'a', 'utf8') as f:
-                    for x in self.modified:
-                        ti = quote(page.name.replace(' ', '_').encode('utf8'))
-                        difflink = '//no.wikipedia.org/w/index.php?title=%s&diff=%s&oldid=%s' % (ti, res['newrevid'], res['oldrevid'])
-                        f.write('| [[%s]] ([%s diff]) || Endret %s fra %s til %s || %s\n|-\n' % (page.name, difflink, x['key'], x['old'], x['new'], 'kompleks' if x['complex'] else ''))
 
-                with codecs.open('modified-simple.txt', 'a', 'utf8') as f:
-                    for x in self.modified:
-                        ti = quote(page.name.replace(' ', '_').encode('utf8'))
-                        f.write('%s\t%s\t%s\n' % (page.name, x['old'], x['new']))
+def get_page_state_version():
+    """
+    Return a hash of the ruleset version and the code that checks the
+    templates on a page. Stored page states are only used for the same
+    version.
+    """
+    parts = [get_ruleset_version(), ' '.join(citation_templates)]
+    sources = [TemplateSnapshot, SnapshotParam, apply_edits, Template, Page, Validator, YearValidator, MonthValidator,
+               NumericMonthValidator, DateValidator, VisitDateValidator, validate_year, validate_date, validate_month,
+               validate_numeric_month, get_year_suggestion, inspect.getmodule(find_templates)]
+    for obj in sources:
+        parts.append(inspect.getsource(obj))
+    return hashlib.sha1('\n'.join(parts).encode('utf8')).hexdigest()
 
 
 def main():
@@ -767,28 +1462,97 @@ def main():
     parser = argparse.ArgumentParser(description='CS1 cleanup')
     parser.add_argument('--page', required=False, help='Name of a single page to check')
     parser.add_argument('--interactive_mode', default=False, action='store_true', help='Interactive mode')
+    parser.add_argument('--cache-size', type=int, default=suggestion_cache.maxsize, help='Number of suggestions to keep in memory')
+    parser.add_argument('--stopwords', help='File with additional words that are never month or season names')
+    parser.add_argument('--suggestion-store', default='suggestions.db', help='SQLite file to store suggestions in between runs. Set to an empty string to disable.')
+    parser.add_argument('--state-store', default='pages.db', help='SQLite file to store what was found on each page in between runs. Pages that have not been edited since are not checked again. Set to an empty string to disable.')
+    parser.add_argument('--section-saves', default=False, action='store_true', help='Save only the section with the fixed dates when they are all in one section')
+    parser.add_argument('--batch-size', type=int, default=50, help='Number of pages to fetch the text of per API request (at most 50, or 500 for bots)')
+    parser.add_argument('--queue-size', type=int, default=50, help='Number of pages that can wait to be checked, and to be saved')
+    parser.add_argument('--edits-per-minute', type=float, default=60, help='Maximum number of edits per minute')
+    parser.add_argument('--edit-burst', type=int, default=1, help='Number of edits that can be made in a row without waiting, if the edits before them were far enough apart')
+    parser.add_argument('--maxlag', type=int, help='Wait with requests while the database replication lag is above this many seconds. Overrides max_lag in config.json (default 5).')
+    parser.add_argument('--dump', help='Check the articles in an XML dump (pages-articles.xml or .xml.bz2) instead of the pages in the category. Nothing is fetched or saved.')
+    parser.add_argument('--dump-output', default='dump.jsonl', help='File to write the fixes and unresolved values found in the dump to, as JSON lines')
+    parser.add_argument('--dump-index', help='Index of a multistream dump (pages-articles-multistream-index.txt.bz2), to check the dump in several processes')
+    parser.add_argument('--processes', type=int, default=1, help='Number of processes to check a multistream dump with')
+    parser.add_argument('--rule-order', help='JSON file with rule hit counts. If given, rules are tried in order of hits from earlier runs, and the counts are updated at the end.')
     args = parser.parse_args()
 
+    suggestion_cache.resize(args.cache_size)
+    if args.stopwords:
+        month_stopwords.update(read_words(args.stopwords))
+    if args.suggestion_store:
+        open_suggestion_store(args.suggestion_store)
+    if args.rule_order:
+        load_rule_order(args.rule_order)
+    if args.dump:
+        # Imported here since the dump module uses this module
+        from .dump import process_dump
+        process_dump(args.dump, args.dump_output, args.dump_index, args.processes)
+        finish_run(args)
+        return
+
+    state_store = None
+    if args.state_store:
+        state_store = PageStateStore(args.state_store, get_page_state_version())
+
     cnt = {'pagesChecked': 0, 'datesChecked': 0, 'datesModified': 0, 'datesUnresolved': 0}
     pagesWithNoKnownErrors = []
     unresolved = []
 
     config = json.load(open('config.json', 'r'))
+    config.setdefault('max_lag', 5)
+
+    global edit_scheduler
+    edit_scheduler = EditScheduler(args.edits_per_minute / 60., args.edit_burst)
 
+    if args.maxlag is not None:
+        config['max_lag'] = args.maxlag
     site = Site('no.wikipedia.org', **config)
+    edit_scheduler.install(site)
     cat = site.Categories['Sider med kildemaler som inneholder datofeil']
 
     if args.page:
         page = site.pages[args.page]
-        p = Page(page, args.interactive_mode)
+        p = Page(page, args.interactive_mode, args.section_saves)
 
     else:
+        if state_store is None:
+            pages = category_pages(site, cat.name, namespace=0, batch_size=args.batch_size)
+        else:
+            # List the pages with their latest revision ids, and only fetch the text of
+            # the pages that have been edited since they were last checked
+            members = list(category_members(site, cat.name, namespace=0))
+            state_store.prune([info['title'] for info in members])
+            changed = []
+            for info in members:
+                state = state_store.get(info['title']) if state_store.is_current(info['title'], info.get('lastrevid')) else None
+                if state is None:
+                    changed.append(info['title'])
+                    continue
+                cnt['pagesChecked'] += 1
+                cnt['datesChecked'] += state[0]
+                cnt['datesUnresolved'] += len(state[1])
+                if len(state[1]) == 0:
+                    pagesWithNoKnownErrors.append(info['title'])
+                unresolved.extend(state[1])
+            logger.info('%d of %d pages have been edited since they were last checked', len(changed), len(members))
+            pages = fetch_pages(site, changed, batch_size=args.batch_size)
+
+        # The pages are fetched and checked in threads of their own while the pages
+        # checked before them are saved here
+        check = partial(Page, interactive_mode=args.interactive_mode, section_saves=args.section_saves, save=False)
         n = 0
-        for page in cat.members(namespace=0):
+        for p in pipeline(pages, [check], args.queue_size):
             n += 1
+            page = p.page
             # logging.info('%02d %s - %.1f MB', n, page.name, memory_usage_psutil())
             # print "-----------[ %s ]-----------" % page.name
-            p = Page(page, args.interactive_mode)
+            p.save()
+            # Pages with fixes that weren't saved are checked again next time
+            if state_store is not None and (len(p.modified) == 0 or p.newrevid is not None):
+                state_store.set(page.name, p.newrevid or page.revision, p.checked, p.unresolved)
             cnt['pagesChecked'] += 1
             cnt['datesChecked'] += p.checked
             cnt['datesModified'] += len(p.modified)
@@ -822,7 +1586,32 @@ def main():
         unresolvedTxt += u'| [[%(page)s]] || %(key)s || <nowiki>%(value)s</nowiki> || %(problem)s\n|-\n' % p
 
     page = site.pages[u'Bruker:DanmicholoBot/Datofiks/Uløst']
-    page.save(unresolvedTxt, summary='Oppdaterer')
+    edit_scheduler.run(page.save, unresolvedTxt, summary='Oppdaterer')
+
+    edit_scheduler.log_stats()
+    if state_store is not None:
+        state_store.close()
+    finish_run(args)
+
+
+def finish_run(args):
+    log_cache_stats()
+    log_rule_stats()
+    if args.rule_order:
+        save_rule_order(args.rule_order)
+    if suggestion_store is not None:
+        suggestion_store.close()
+
+
+def log_cache_stats():
+    for name, cache in [('Suggestion', suggestion_cache), ('Date validation', date_cache), ('Year validation', year_cache),
+                        ('Month miss', month_misses), ('Month or season miss', month_or_season_misses)]:
+        logger.info('%s cache: %d hits, %d misses, %d entries', name, cache.hits, cache.misses, len(cache))
+
+
+def log_rule_stats():
+    for rule in suggestion_rules:
+        logger.info('Rule %s: %d hits of %d attempts, %.3f s', rule.name, rule.hits, rule.attempts, rule.time)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,265 @@
+# encoding=utf8
+# Checking the pages in an XML dump (such as nowiki-latest-pages-articles.xml.bz2)
+# instead of the pages in the tracking category, without any network access.
+# The dump is read with an incremental parser, and each page is dropped once
+# it has been checked, so memory use doesn't grow with the size of the dump.
+#
+# A multistream dump (pages-articles-multistream.xml.bz2) is made up of bz2
+# streams of 100 pages each, which can be decompressed on their own. With
+# the index that comes with it, the streams are split between processes.
+from __future__ import unicode_literals
+
+import bz2
+import io
+import json
+import logging
+from collections import deque
+from xml.etree import ElementTree
+
+import six
+
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+    # Python 2 without the futures backport
+    ProcessPoolExecutor = None
+
+from . import cs1cleanup as core
+from .batch import in_worker
+
+logger = logging.getLogger('cs1cleanup')
+
+
+class DumpPage(object):
+    """
+    A page from a dump, with the attributes of a mwclient page that Page
+    uses. Dump pages can't be saved.
+    """
+
+    __slots__ = ('name', 'namespace', 'revision', 'redirect', 'content')
+
+    def __init__(self, name, namespace, revision, redirect, content):
+        self.name = name
+        self.namespace = namespace
+        self.revision = revision
+        self.redirect = redirect
+        self.content = content
+
+    def text(self, section=None, cache=True):
+        return self.content
+
+
+def local_name(tag):
+    # The tag without the export schema namespace, which changes between dump versions
+    return tag.rsplit('}', 1)[-1]
+
+
+def child_text(elem, name):
+    for child in elem:
+        if local_name(child.tag) == name:
+            return child.text or ''
+
+
+def open_dump(path):
+    if path.endswith('.bz2'):
+        return bz2.BZ2File(path)
+    return io.open(path, 'rb')
+
+
+def iter_dump(fileobj):
+    """
+    Yield the pages in an XML dump read from fileobj as DumpPage objects,
+    with the text of the last revision in the dump.
+    """
+    root = None
+    for event, elem in ElementTree.iterparse(fileobj, events=('start', 'end')):
+        if root is None:
+            root = elem
+        if event != 'end' or local_name(elem.tag) != 'page':
+            continue
+        revision = None
+        redirect = False
+        for child in elem:
+            name = local_name(child.tag)
+            if name == 'revision':
+                revision = child
+            elif name == 'redirect':
+                redirect = True
+        if revision is not None:
+            yield DumpPage(child_text(elem, 'title'), int(child_text(elem, 'ns')), int(child_text(revision, 'id')),
+                           redirect, child_text(revision, 'text'))
+        # The pages that have been read are of no use anymore
+        root.clear()
+
+
+def check_page(page):
+    """
+    Check a dump page. Returns the number of dates checked, and the result
+    as a dict, or None if there is nothing to fix and no unresolved values
+    on the page.
+    """
+    p = core.Page(page, False, save=False)
+    if len(p.modified) == 0 and len(p.unresolved) == 0:
+        return p.checked, None
+    return p.checked, {
+        'title': page.name,
+        'revid': page.revision,
+        'checked': p.checked,
+        'modified': p.modified,
+        'unresolved': p.unresolved,
+        'edits': p.edits,
+    }
+
+
+def check_pages(pages, cnt):
+    """
+    Check the articles (main namespace pages that are not redirects) among
+    the pages, add to the counts in cnt, and yield a line of JSON for each
+    article with dates that can be fixed or unresolved values. A page that
+    can't be checked is logged and counted as an error, and the next pages
+    are checked as usual.
+    """
+    for page in pages:
+        if page.namespace != 0 or page.redirect:
+            continue
+        try:
+            checked, result = check_page(page)
+        except Exception as e:
+            logger.warning('Failed to check %s (revision %d): %s: %s', page.name, page.revision,
+                           type(e).__name__, e)
+            cnt['errors'] += 1
+            continue
+        cnt['pagesChecked'] += 1
+        cnt['datesChecked'] += checked
+        if result is not None:
+            cnt['datesModified'] += len(result['modified'])
+            cnt['datesUnresolved'] += len(result['unresolved'])
+            yield six.text_type(json.dumps(result, ensure_ascii=False)) + '\n'
+
+
+def new_counts():
+    return {'pagesChecked': 0, 'datesChecked': 0, 'datesModified': 0, 'datesUnresolved': 0, 'errors': 0}
+
+
+def read_index(path):
+    """
+    Return the offsets of the streams in a multistream dump, from its index
+    (pages-articles-multistream-index.txt or .txt.bz2), which has a line
+    with offset:page id:title for each page.
+    """
+    offsets = []
+    with open_dump(path) as f:
+        for line in f:
+            offset = int(line.split(b':', 1)[0])
+            if not offsets or offsets[-1] != offset:
+                offsets.append(offset)
+    return offsets
+
+
+def read_stream(f, start, end):
+    # Decompress the stream that starts at start. The last stream with pages is
+    # followed by the stream with the end tag, which isn't in the index, so it
+    # is read until the end of the stream instead of until the next offset.
+    # BZ2Decompressor.eof is only there from Python 3.3, so the end of the
+    # stream is found from the data left over after it instead.
+    f.seek(start)
+    decompressor = bz2.BZ2Decompressor()
+    data = []
+    while True:
+        block = f.read(end - f.tell() if end is not None else 1 << 20)
+        if not block:
+            break
+        try:
+            data.append(decompressor.decompress(block))
+        except EOFError:
+            # The stream ended with the block before
+            break
+        if decompressor.unused_data:
+            break
+    return b''.join(data)
+
+
+def check_streams(path, streams):
+    """
+    Check the pages in the given streams of a multistream dump, given as
+    (start, end) offsets. Returns the counts and the lines of JSON, as for
+    check_pages.
+    """
+    cnt = new_counts()
+    level = logger.level
+    logger.setLevel(logging.WARNING)
+    try:
+        with io.open(path, 'rb') as f:
+            # The streams hold the page elements without the root element around them
+            xml = b''.join([b'<mediawiki>'] + [read_stream(f, start, end) for start, end in streams] + [b'</mediawiki>'])
+        lines = list(check_pages(iter_dump(io.BytesIO(xml)), cnt))
+    finally:
+        logger.setLevel(level)
+    return cnt, lines
+
+
+def ordered_map(executor, func, args_list, ahead):
+    # Like executor.map, but with at most `ahead` tasks submitted and not yet
+    # returned, so that the results of the later tasks don't pile up while
+    # waiting for one that takes long
+    pending = deque()
+    for args in args_list:
+        pending.append(executor.submit(func, *args))
+        if len(pending) >= ahead:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def process_dump(path, output, index=None, processes=1, streams_per_task=10):
+    """
+    Check the articles (main namespace pages that are not redirects) in the
+    dump, and write a line of JSON to the output file for each article
+    with dates that can be fixed or unresolved values. The line holds the
+    title and the revision id, the number of dates checked, the fixes and
+    unresolved values, as in Page, and the edits that would be made, as
+    (start, end, replacement) lists. Returns the counts of pages and dates,
+    and of the pages that couldn't be checked.
+
+    If the dump is a multistream dump, and `index` is the path to its index,
+    the streams are checked `streams_per_task` at a time in a pool of
+    `processes` processes. The output is in dump order either way. The
+    suggestion store is not used in the processes.
+    """
+    cnt = new_counts()
+
+    if index is None:
+        # Logging every page would give millions of lines
+        level = logger.level
+        logger.setLevel(logging.WARNING)
+        try:
+            with open_dump(path) as f, io.open(output, 'w', encoding='utf8') as out:
+                out.writelines(check_pages(iter_dump(f), cnt))
+        finally:
+            logger.setLevel(level)
+
+    else:
+        offsets = read_index(index)
+        streams = list(zip(offsets, offsets[1:] + [None]))
+        tasks = [streams[i:i + streams_per_task] for i in range(0, len(streams), streams_per_task)]
+        logger.info('Checking %d streams in %d tasks', len(streams), len(tasks))
+        if processes > 1 and ProcessPoolExecutor is not None:
+            executor = ProcessPoolExecutor(processes)
+            results = ordered_map(executor, in_worker, [(check_streams, path, task) for task in tasks], processes * 2)
+        else:
+            executor = None
+            results = (check_streams(path, task) for task in tasks)
+        try:
+            with io.open(output, 'w', encoding='utf8') as out:
+                for task_cnt, lines in results:
+                    out.writelines(lines)
+                    for key in cnt:
+                        cnt[key] += task_cnt[key]
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    logger.info('Checked %(pagesChecked)d pages with %(datesChecked)d dates: %(datesModified)d can be fixed, %(datesUnresolved)d unresolved', cnt)
+    if cnt['errors']:
+        logger.warning('Failed to check %(errors)d pages', cnt)
+    return cnt
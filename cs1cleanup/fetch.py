@@ -0,0 +1,132 @@
+# encoding=utf8
+# Fetching the pages in a category together with their text. Listing the
+# category members and then asking for the text of each page takes one
+# request per page, while a categorymembers generator with prop=revisions
+# gets the text of a whole batch of pages in one request.
+from __future__ import unicode_literals
+
+import logging
+import time
+
+from mwclient.page import Page as ClientPage
+from mwclient.util import parse_timestamp
+
+logger = logging.getLogger('cs1cleanup')
+
+
+class PrefetchedPage(ClientPage):
+    """
+    A mwclient page with the text of the current revision already fetched.
+    text() returns that text instead of asking the API for it, unless a
+    section or expanded templates are asked for, or cache is False. The
+    revision timestamp is used to detect edit conflicts when saving, as for
+    a text fetched with text().
+    """
+
+    def __init__(self, site, info):
+        super(PrefetchedPage, self).__init__(site, info['title'], info)
+        self.prefetched_text = None
+        revisions = info.get('revisions')
+        if revisions:
+            rev = revisions[0]
+            self.prefetched_text = rev['slots']['main']['*'] if 'slots' in rev else rev['*']
+            self.revision = rev.get('revid', self.revision)
+            self.last_rev_time = parse_timestamp(rev['timestamp'])
+
+    def text(self, section=None, expandtemplates=False, cache=True, slot='main'):
+        if self.prefetched_text is None or section is not None or expandtemplates or not cache or slot != 'main':
+            return super(PrefetchedPage, self).text(section, expandtemplates, cache, slot)
+        self.edit_time = time.gmtime()
+        return self.prefetched_text
+
+
+revision_props = {
+    'prop': 'info|revisions',
+    'inprop': 'protection',
+    'rvprop': 'content|timestamp|ids',
+    'rvslots': 'main',
+}
+
+
+def query_pages(site, query):
+    """
+    Yield the info of each page returned by the query, continuing the query
+    until all the pages are returned. If the revisions of all the pages
+    don't fit in one response, the API leaves them out for some of the
+    pages and returns them in the next responses, so the pages are only
+    yielded when the batch they are in is complete.
+    """
+    args = dict(query, **{'continue': ''})
+    pages = {}
+    order = []
+    requests = 0
+    while True:
+        data = site.get('query', **args)
+        requests += 1
+        for pageid, info in data.get('query', {}).get('pages', {}).items():
+            if pageid in pages:
+                if 'revisions' in info:
+                    pages[pageid]['revisions'] = info['revisions']
+            else:
+                pages[pageid] = info
+                order.append(pageid)
+
+        if 'batchcomplete' in data:
+            logger.debug('Fetched %d pages in %d request(s)', len(order), requests)
+            for pageid in order:
+                yield pages[pageid]
+            pages = {}
+            order = []
+            requests = 0
+
+        if 'continue' not in data:
+            break
+        # The continue values from the last response replace those from the one before
+        args = dict(query, **data['continue'])
+
+    for pageid in order:
+        yield pages[pageid]
+
+
+def category_pages(site, category, namespace=0, batch_size=50):
+    """
+    Yield the pages in the category (a title with the namespace prefix) as
+    PrefetchedPage objects, fetching `batch_size` pages per request. The API
+    allows up to 50 pages with text per request, or 500 for bots.
+    """
+    query = dict(revision_props, generator='categorymembers', gcmtitle=category, gcmnamespace=namespace,
+                 gcmlimit=batch_size)
+    for info in query_pages(site, query):
+        yield PrefetchedPage(site, info)
+
+
+def category_members(site, category, namespace=0):
+    """
+    Yield the info of the pages in the category, without their text. The
+    info includes the title and the id of the latest revision (lastrevid).
+    """
+    query = {
+        'generator': 'categorymembers',
+        'gcmtitle': category,
+        'gcmnamespace': namespace,
+        'gcmlimit': 'max',
+        'prop': 'info',
+    }
+    return query_pages(site, query)
+
+
+def fetch_pages(site, titles, batch_size=50):
+    """
+    Yield the pages with the given titles as PrefetchedPage objects, in
+    the same order, fetching `batch_size` pages per request.
+    """
+    for start in range(0, len(titles), batch_size):
+        batch = titles[start:start + batch_size]
+        pages = {}
+        for info in query_pages(site, dict(revision_props, titles='|'.join(batch))):
+            pages[info['title']] = PrefetchedPage(site, info)
+        for title in batch:
+            if title in pages:
+                yield pages[title]
+            else:
+                logger.warning('Page not found: %s', title)
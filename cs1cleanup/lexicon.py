@@ -0,0 +1,80 @@
+# encoding=utf8
+from __future__ import unicode_literals
+
+import os
+import codecs
+
+data_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'months.txt')
+
+
+class Node(object):
+
+    __slots__ = ('children', 'entry', 'months', 'seasons')
+
+    def __init__(self):
+        self.children = {}
+        self.entry = None  # (canonical name, kind) if a word ends here
+        self.months = set()  # canonical month names of all words below this node
+        self.seasons = set()  # canonical season names of all words below this node
+
+
+class Lexicon(object):
+    """
+    Trie of month and season names in several languages, each mapped to
+    the canonical Norwegian name. Tokens are looked up by exact match, or
+    as a month abbreviation: a prefix of at least `min_prefix` letters that
+    belongs to only one canonical month name, and to no season name. Both
+    take O(len(token)). Season names are only matched exactly, since short
+    words like "for" and "her" are prefixes of season names in some
+    language.
+    """
+
+    def __init__(self, min_prefix=3):
+        self.root = Node()
+        self.min_prefix = min_prefix
+        self.canonical = {'month': [], 'season': []}
+
+    def add(self, word, canonical, kind):
+        node = self.root
+        for char in word:
+            node = node.children.setdefault(char, Node())
+            (node.months if kind == 'month' else node.seasons).add(canonical)
+        node.entry = (canonical, kind)
+
+    def load(self, path):
+        with codecs.open(path, 'r', 'utf8') as f:
+            for line in f:
+                line = line.split('#')[0].split()
+                if len(line) < 2:
+                    continue
+                canonical, kind = line[0], line[1]
+                if kind not in self.canonical:
+                    raise ValueError('Unknown kind "%s" for "%s" in %s' % (kind, canonical, path))
+                self.canonical[kind].append(canonical)
+                for word in [canonical] + line[2:]:
+                    self.add(word, canonical, kind)
+        return self
+
+    def lookup(self, token, include_seasons=False):
+        """
+        Return the canonical month name for token, or the canonical month or
+        season name if include_seasons is set. Returns None if the token is
+        not known or is an ambiguous abbreviation.
+        """
+        token = token.lower().rstrip('.')
+        node = self.root
+        for char in token:
+            node = node.children.get(char)
+            if node is None:
+                return None
+
+        if node.entry is not None and (include_seasons or node.entry[1] == 'month'):
+            return node.entry[0]
+
+        if len(token) < self.min_prefix or (include_seasons and node.seasons):
+            return None
+        if len(node.months) == 1:
+            return next(iter(node.months))
+
+
+lexicon = Lexicon().load(data_path)
@@ -0,0 +1,81 @@
+# encoding=utf8
+# Running the steps of a job in threads connected by bounded queues, so
+# that fetching pages, checking them and saving them overlap instead of
+# waiting for each other. Each step runs in a single thread, so the items
+# stay in order, and the queues keep the earlier steps from running too far
+# ahead of the later ones.
+from __future__ import unicode_literals
+
+import sys
+import threading
+
+import six
+from six.moves import queue
+
+done = object()
+
+
+class Failure(object):
+    # An exception raised in one of the threads, passed on to the next step
+
+    __slots__ = ('exc_info',)
+
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+
+def put(q, item, stop):
+    # Wait for room in the queue, unless the consumer has stopped
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+
+def read(q):
+    # Yield the items in the queue until the step before it is done
+    while True:
+        item = q.get()
+        if item is done:
+            return
+        if isinstance(item, Failure):
+            six.reraise(*item.exc_info)
+        yield item
+
+
+def run_step(func, items, out, stop):
+    try:
+        for item in items:
+            if stop.is_set():
+                return
+            put(out, item if func is None else func(item), stop)
+    except Exception:
+        put(out, Failure(sys.exc_info()), stop)
+    else:
+        put(out, done, stop)
+
+
+def pipeline(items, steps, queue_size=50):
+    """
+    Yield func(item) for each of the items, where func is the steps, a list
+    of functions, applied one after the other. The items are taken from the
+    iterable in one thread, and each step runs in a thread of its own, with
+    at most `queue_size` items waiting between two steps. The results are
+    yielded in the order of the items. An exception in any of the threads is
+    raised here, and the threads stop when the generator is closed.
+    """
+    stop = threading.Event()
+    queues = [queue.Queue(queue_size) for i in range(len(steps) + 1)]
+    sources = [iter(items)] + [read(q) for q in queues[:-1]]
+    threads = [threading.Thread(target=run_step, args=(func, source, out, stop))
+               for func, source, out in zip([None] + list(steps), sources, queues)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        for item in read(queues[-1]):
+            yield item
+    finally:
+        stop.set()
@@ -0,0 +1,144 @@
+# encoding=utf8
+from __future__ import unicode_literals
+
+import json
+import sqlite3
+import logging
+
+from .cache import LRUCache, missing
+
+logger = logging.getLogger('cs1cleanup')
+
+
+class SuggestionStore(object):
+    """
+    On-disk store of date suggestions produced by the rules, keyed by the
+    original value. Entries belong to a rule-set version, and entries from
+    other versions are dropped when the store is opened, so that changes to
+    the rules never serve stale suggestions.
+
+    The last `cache_size` values looked up are kept in memory, along with
+    whether they were found, so repeated lookups don't touch the database
+    while memory use stays bounded however large the store grows.
+    """
+
+    def __init__(self, path, ruleset, commit_interval=100, cache_size=10000):
+        self.path = path
+        self.ruleset = ruleset
+        self.commit_interval = commit_interval
+        self.pending = 0
+        # The store is used from the thread that checks the pages, one thread at a time
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS suggestions (ruleset TEXT, value TEXT, suggestion TEXT, PRIMARY KEY (ruleset, value))')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        cur = self.conn.execute('DELETE FROM suggestions WHERE ruleset != ?', (ruleset,))
+        if cur.rowcount > 0:
+            logger.info('Rules have changed, dropped %d stored suggestions', cur.rowcount)
+        self.conn.commit()
+        self.suggestions = LRUCache(cache_size)
+        logger.debug('Opened %s with %d entries', path, len(self))
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM suggestions WHERE ruleset = ?', (self.ruleset,)).fetchone()[0]
+
+    def get(self, value):
+        suggestion = self.suggestions.get(value, missing)
+        if suggestion is missing:
+            row = self.conn.execute('SELECT suggestion FROM suggestions WHERE ruleset = ? AND value = ?', (self.ruleset, value)).fetchone()
+            suggestion = row[0] if row is not None else None
+            self.suggestions.set(value, suggestion)
+        return suggestion
+
+    def set(self, value, suggestion):
+        if self.get(value) == suggestion:
+            return
+        self.suggestions.set(value, suggestion)
+        self.conn.execute('INSERT OR REPLACE INTO suggestions (ruleset, value, suggestion) VALUES (?, ?, ?)', (self.ruleset, value, suggestion))
+        self.pending += 1
+        if self.pending >= self.commit_interval:
+            self.commit()
+
+    def get_meta(self, key):
+        row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        if row is not None:
+            return row[0]
+
+    def set_meta(self, key, value):
+        self.conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+        self.conn.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+
+class PageStateStore(object):
+    """
+    On-disk store of what was found on each page the last time it was
+    checked: the revision that was checked, the number of date values and
+    the values that could not be fixed. As for SuggestionStore, entries
+    belong to a rule-set version, and entries from other versions are
+    dropped when the store is opened, so pages are checked again when the
+    rules change.
+    """
+
+    def __init__(self, path, ruleset, commit_interval=100):
+        self.path = path
+        self.ruleset = ruleset
+        self.commit_interval = commit_interval
+        self.pending = 0
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS pages (title TEXT PRIMARY KEY, ruleset TEXT, revid INTEGER, checked INTEGER, unresolved TEXT)')
+        cur = self.conn.execute('DELETE FROM pages WHERE ruleset != ?', (ruleset,))
+        if cur.rowcount > 0:
+            logger.info('Rules have changed, dropped the state of %d pages', cur.rowcount)
+        self.conn.commit()
+        self.revids = dict(self.conn.execute('SELECT title, revid FROM pages'))
+        logger.debug('Read the state of %d pages from %s', len(self.revids), path)
+
+    def __len__(self):
+        return len(self.revids)
+
+    def is_current(self, title, revid):
+        """
+        Return True if the page was checked at revision revid.
+        """
+        return self.revids.get(title) == revid
+
+    def get(self, title):
+        """
+        Return the number of date values and the list of unresolved values
+        stored for the page, or None if there is no state for it.
+        """
+        row = self.conn.execute('SELECT checked, unresolved FROM pages WHERE title = ?', (title,)).fetchone()
+        if row is not None:
+            return row[0], json.loads(row[1])
+
+    def set(self, title, revid, checked, unresolved):
+        self.revids[title] = revid
+        self.conn.execute('INSERT OR REPLACE INTO pages (title, ruleset, revid, checked, unresolved) VALUES (?, ?, ?, ?, ?)',
+                          (title, self.ruleset, revid, checked, json.dumps(unresolved)))
+        self.pending += 1
+        if self.pending >= self.commit_interval:
+            self.commit()
+
+    def prune(self, titles):
+        """
+        Drop the state of the pages that are not in titles.
+        """
+        titles = set(titles)
+        for title in [title for title in self.revids if title not in titles]:
+            del self.revids[title]
+            self.conn.execute('DELETE FROM pages WHERE title = ?', (title,))
+
+    def commit(self):
+        self.conn.commit()
+        self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.conn.close()
@@ -0,0 +1,179 @@
+# encoding=utf8
+# Rate limiting of edits. Edits are limited with a token bucket, so that an
+# edit only has to wait if the edits before it were made too close together.
+# When the server asks us to wait, because the replication lag is above
+# maxlag or with a Retry-After header, the next edits wait as well.
+from __future__ import unicode_literals
+
+import email.utils
+import logging
+import threading
+import time
+
+from mwclient.errors import MaximumRetriesExceeded
+from mwclient.sleep import Sleeper, Sleepers
+from requests.exceptions import HTTPError
+
+logger = logging.getLogger('cs1cleanup')
+
+
+def retry_after(response):
+    """
+    Return the number of seconds to wait given by the Retry-After header of
+    the response, as a number of seconds or a date, or None if there is no
+    such header.
+    """
+    value = response.headers.get('retry-after')
+    if not value:
+        return None
+    try:
+        return max(int(value), 0)
+    except ValueError:
+        date = email.utils.parsedate_tz(value)
+        if date is None:
+            return None
+        return max(email.utils.mktime_tz(date) - time.time(), 0)
+
+
+class EditScheduler(object):
+    """
+    Token bucket for edits: `rate` edits per second, and up to `burst` edits
+    in a row without waiting. Only the threads that call wait() or run() are
+    held up, so pages can be checked while an edit is waiting.
+
+    The time spent waiting is counted separately from the time spent
+    making edits: `throttled` is the time spent waiting for the rate limit,
+    and `backed_off` the time spent waiting because the server asked for it.
+    """
+
+    def __init__(self, rate=1.0, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.time()
+        self.not_before = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+        self.edits = 0
+        self.working = 0.0
+        self.throttled = 0.0
+        self.backed_off = 0.0
+
+    def wait(self):
+        """
+        Wait until the next edit can be made.
+        """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # The token is taken now, so a token that isn't there yet is reserved for
+            # this edit and the edits waiting after it have to wait longer
+            self.tokens -= 1
+            delay = max(-self.tokens / self.rate, self.not_before - now, 0)
+            self.throttled += delay
+        if delay > 0:
+            logger.debug('Waiting %.1f s before the next edit', delay)
+            time.sleep(delay)
+
+    def back_off(self, seconds):
+        """
+        Wait because the server asked us to, and hold back the next edits
+        for as long.
+        """
+        with self.lock:
+            self.not_before = max(self.not_before, time.time() + seconds)
+            self.backed_off += seconds
+        self.local.backed_off = getattr(self.local, 'backed_off', 0.0) + seconds
+        time.sleep(seconds)
+
+    def run(self, func, *args, **kwargs):
+        """
+        Wait until the next edit can be made, and then call func, which
+        makes the edit.
+        """
+        self.wait()
+        backed_off = getattr(self.local, 'backed_off', 0.0)
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.time() - start - (getattr(self.local, 'backed_off', 0.0) - backed_off)
+            with self.lock:
+                self.edits += 1
+                self.working += elapsed
+
+    def install(self, site):
+        """
+        Let the scheduler handle the waiting when a mwclient site retries a
+        request, so that waiting because of lag or Retry-After holds back
+        the edits too, and is counted as time backed off.
+
+        mwclient only reads Retry-After together with a lag header. For
+        other 5xx responses it retries after a wait of its own, and it
+        doesn't retry 429 responses at all. So the Retry-After header of
+        these responses is kept for the next wait, and the requests that get
+        a 429 response are retried here.
+        """
+        site.sleepers = SchedulerSleepers(self, site.sleepers.max_retries, site.sleepers.retry_timeout,
+                                          site.sleepers.callback)
+        site.connection.hooks['response'].append(self.read_retry_after)
+        raw_call = site.raw_call
+
+        def retrying_raw_call(script, data, *args, **kwargs):
+            sleeper = site.sleepers.make((script, data))
+            while True:
+                try:
+                    return raw_call(script, data, *args, **kwargs)
+                except HTTPError as e:
+                    if e.response is None or e.response.status_code != 429:
+                        raise
+                    logger.warning('Too many requests, retrying in a moment')
+                    # Without Retry-After, wait at least retry_timeout seconds
+                    sleeper.sleep(sleeper.retry_timeout)
+
+        site.raw_call = retrying_raw_call
+
+    def read_retry_after(self, response, *args, **kwargs):
+        # Response hook that keeps the Retry-After of the last response, if it asked us to wait
+        seconds = None
+        if response.status_code == 429 or response.status_code >= 500:
+            seconds = retry_after(response)
+        self.local.retry_after = seconds
+
+    def take_retry_after(self):
+        seconds = getattr(self.local, 'retry_after', None)
+        self.local.retry_after = None
+        return seconds or 0
+
+    def log_stats(self):
+        logger.info('Edits: %d made in %.1f s, waited %.1f s for the rate limit and %.1f s for the server',
+                    self.edits, self.working, self.throttled, self.backed_off)
+
+
+class SchedulerSleepers(Sleepers):
+
+    def __init__(self, scheduler, max_retries, retry_timeout, callback):
+        Sleepers.__init__(self, max_retries, retry_timeout, callback)
+        self.scheduler = scheduler
+
+    def make(self, args=None):
+        return SchedulerSleeper(self.scheduler, args, self.max_retries, self.retry_timeout, self.callback)
+
+
+class SchedulerSleeper(Sleeper):
+    # Same as Sleeper, except that the sleeping is done by the scheduler
+
+    def __init__(self, scheduler, args, max_retries, retry_timeout, callback):
+        Sleeper.__init__(self, args, max_retries, retry_timeout, callback)
+        self.scheduler = scheduler
+
+    def sleep(self, min_time=0):
+        self.retries += 1
+        if self.retries > self.max_retries:
+            raise MaximumRetriesExceeded(self, self.args)
+        self.callback(self, self.retries, self.args)
+        timeout = max(self.retry_timeout * (self.retries - 1), min_time, self.scheduler.take_retry_after())
+        logger.debug('Sleeping for %d seconds', timeout)
+        self.scheduler.back_off(timeout)
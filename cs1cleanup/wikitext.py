@@ -0,0 +1,356 @@
+# encoding=utf8
+# A scanner that finds the templates in wikitext and the offsets of their
+# parameters, without building a parse tree. It follows the rules of the
+# mwtemplates preprocessor (a port of the MediaWiki preprocessor), so that
+# it finds the same templates and parameters as TemplateEditor: braces and
+# brackets are matched on a stack, pipes and equals signs only count
+# directly inside a template, and comments and <nowiki>, <pre> and <math>
+# elements are skipped.
+from __future__ import unicode_literals
+
+import re
+from difflib import SequenceMatcher
+
+element_re = re.compile(r'(math|nowiki|pre)(?:\s|/>|>)|(!--)', re.I)
+search_res = {}
+
+# For each kind of opening bracket: the closing character, the minimum number
+# of brackets, and what a matched number of brackets is (True if it's an
+# element we keep track of, False if it's just literal text)
+rules = {
+    '{': ('}', 2, {2: True, 3: True}),
+    '[': (']', 2, {2: False}),
+}
+
+
+def normalize_name(name):
+    # Same as the key of a mwtemplates Template
+    name = re.sub(r'^(?:[Mm]al|[Tt]emplate):', '', name.strip())
+    if len(name) == 0:
+        return ''
+    return name[0].upper() + name[1:]
+
+
+class Param(object):
+    """
+    A template parameter found by scan_templates. `start` is the position of
+    the pipe in front of the parameter, `eq` the position of the equals sign
+    (None for positional parameters) and `end` the position right after the
+    value. `key` is the name, or the index for positional parameters, as for
+    a mwtemplates Parameter.
+    """
+
+    __slots__ = ('text', 'start', 'eq', 'end', 'key')
+
+    def __init__(self, text, start, eq, end, key):
+        self.text = text
+        self.start = start
+        self.eq = eq
+        self.end = end
+        self.key = key
+
+    @property
+    def value_start(self):
+        return self.start + 1 if self.eq is None else self.eq + 1
+
+    @property
+    def raw_value(self):
+        return self.text[self.value_start:self.end]
+
+    @property
+    def value(self):
+        return self.raw_value.strip()
+
+
+class TemplateSpan(object):
+    """
+    A template found by scan_templates, from `start` (the first opening
+    brace) to `end` (right after the last closing brace).
+    """
+
+    __slots__ = ('text', 'start', 'end', 'name', 'params')
+
+    def __init__(self, text, start, end, name, params):
+        self.text = text
+        self.start = start
+        self.end = end
+        self.name = name
+        self.params = params
+
+    @property
+    def wikitext(self):
+        return self.text[self.start:self.end]
+
+
+class Piece(object):
+    # An opening bracket run on the stack. `parts` holds the start of each part,
+    # which is the pipe for all but the first part, and its equals sign, if any.
+
+    __slots__ = ('open', 'count', 'start', 'parts')
+
+    def __init__(self, open, count, start):
+        self.open = open
+        self.count = count
+        self.start = start
+        self.parts = [[start + count, None]]
+
+
+def strspn(text, char, start, limit=None):
+    # Number of repetitions of char starting at start, up to limit
+    end = len(text) if limit is None else min(len(text), start + limit)
+    i = start
+    while i < end and text[i] == char:
+        i += 1
+    return i - start
+
+
+def get_search_re(chars):
+    pattern = search_res.get(chars)
+    if pattern is None:
+        pattern = search_res[chars] = re.compile('[%s]' % re.escape(chars))
+    return pattern
+
+
+def make_template(text, piece, start, end):
+    title_end = piece.parts[1][0] if len(piece.parts) > 1 else end - 2
+    params = []
+    index = 1
+    for n, (part_start, eq) in enumerate(piece.parts[1:], 1):
+        part_end = piece.parts[n + 1][0] if n + 1 < len(piece.parts) else end - 2
+        if eq is None:
+            key = index
+            index += 1
+        else:
+            key = text[part_start + 1:eq].strip()
+            if key.isnumeric():
+                key = int(key)
+        params.append(Param(text, part_start, eq, part_end, key))
+    return TemplateSpan(text, start, end, normalize_name(text[start + 2:title_end]), params)
+
+
+def scan_templates(text):
+    """
+    Return all the templates in the text, including nested templates, as a
+    list of TemplateSpan objects ordered by start position.
+    """
+    templates = []
+    stack = []
+    no_more_gt = False
+    i = 0
+    n = len(text)
+    while i < n:
+        top = stack[-1] if stack else None
+        search = '[{<'
+        if top is not None:
+            search += rules[top.open][0]
+            if top.open == '{':
+                search += '|'
+                if len(top.parts) > 1 and top.parts[-1][1] is None:
+                    search += '='
+        m = get_search_re(search).search(text, i)
+        if m is None:
+            break
+        i = m.start()
+        char = text[i]
+
+        if char == '<':
+            m = element_re.match(text, i + 1)
+            if m is None:
+                i += 1
+            elif m.group(2):
+                end = text.find('-->', i + 4)
+                i = n if end == -1 else end + 3
+            else:
+                name = m.group(1)
+                tag_end = -1 if no_more_gt else text.find('>', i + len(name) + 1)
+                if tag_end == -1:
+                    no_more_gt = True
+                    i += 1
+                elif text[tag_end - 1] == '/':
+                    i = tag_end + 1
+                else:
+                    close = re.compile(r'</%s\s*>' % re.escape(name)).search(text, tag_end + 1)
+                    i = n if close is None else close.end()
+
+        elif char == '|':
+            top.parts.append([i, None])
+            i += 1
+
+        elif char == '=':
+            top.parts[-1][1] = i
+            i += 1
+
+        elif top is not None and char == rules[top.open][0]:
+            count = strspn(text, char, i, top.count)
+            names = rules[top.open][2]
+            matched = min(count, max(names))
+            while matched > 0 and matched not in names:
+                matched -= 1
+            if matched <= 0:
+                i += count
+                continue
+            start = top.start + top.count - matched
+            if top.open == '{' and matched == 2:
+                templates.append(make_template(text, top, start, i + matched))
+            i += matched
+            stack.pop()
+            if matched < top.count:
+                top.count -= matched
+                top.parts = [[top.start + top.count, None]]
+                if top.count >= rules[top.open][1]:
+                    stack.append(top)
+
+        else:
+            # Opening bracket
+            count = strspn(text, char, i)
+            if count >= rules[char][1]:
+                stack.append(Piece(char, count, i))
+            i += count
+
+    templates.sort(key=lambda tpl: tpl.start)
+    return templates
+
+
+def find_templates(text, names, nested=True):
+    """
+    Return the templates with one of the given names (as normalized by
+    mwtemplates, see normalize_name). If `nested` is False, templates that
+    are nested in one of the other templates returned are left out.
+    """
+    found = []
+    for tpl in scan_templates(text):
+        if tpl.name in names and (nested or not found or tpl.start >= found[-1].end):
+            found.append(tpl)
+    return found
+
+
+def splice(text, edits):
+    """
+    Return the text with each of the edits, given as (start, end, replacement)
+    tuples for ranges that don't overlap, applied.
+    """
+    out = []
+    pos = 0
+    for start, end, replacement in sorted(edits, key=lambda edit: edit[0]):
+        out.append(text[pos:start])
+        out.append(replacement)
+        pos = end
+    out.append(text[pos:])
+    return ''.join(out)
+
+
+def trim_edit(text, start, end, replacement):
+    # Leave out the start and end of the range that the replacement doesn't change
+    old = text[start:end]
+    prefix = 0
+    while prefix < min(len(old), len(replacement)) and old[prefix] == replacement[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < min(len(old), len(replacement)) - prefix and old[-1 - suffix] == replacement[-1 - suffix]:
+        suffix += 1
+    return (start + prefix, end - suffix, replacement[prefix:len(replacement) - suffix])
+
+
+def template_edits(old, new):
+    # Edits that turn the parameters of template old into those of template new. The
+    # parameters are matched by their names, including the whitespace around them.
+    old_names = [p.text[p.start:p.value_start] for p in old.params]
+    new_names = [p.text[p.start:p.value_start] for p in new.params]
+    edits = []
+    matcher = SequenceMatcher(None, old_names, new_names, autojunk=False)
+    for op, i1, i2, j1, j2 in matcher.get_opcodes():
+        if op == 'equal':
+            for p, q in zip(old.params[i1:i2], new.params[j1:j2]):
+                if p.raw_value != q.raw_value:
+                    edits.append((p.value_start, p.end, q.raw_value))
+            continue
+        start = old.params[i1].start if i1 < len(old.params) else old.end - 2
+        end = old.params[i2 - 1].end if i1 < i2 else start
+        replacement = new.text[new.params[j1].start:new.params[j2 - 1].end] if j1 < j2 else ''
+        edits.append((start, end, replacement))
+    return edits
+
+
+def minimal_edits(text, start, end, replacement):
+    """
+    Return edits, as for splice, that turn text[start:end] into replacement
+    by changing only the template parameters that differ. The edits are
+    checked by applying them, and if the result is not the replacement, a
+    single edit replacing the whole range is returned.
+    """
+    old = text[start:end]
+    old_templates = scan_templates(old)
+    new_templates = scan_templates(replacement)
+    edits = []
+    if [tpl.name for tpl in old_templates] == [tpl.name for tpl in new_templates]:
+        for old_tpl, new_tpl in zip(old_templates, new_templates):
+            edits.extend(template_edits(old_tpl, new_tpl))
+        # A changed parameter in a nested template also changes the parameter it's
+        # nested in, so only keep the innermost edits
+        edits = [edit for edit in edits
+                 if not any(edit[0] < other[0] and other[1] < edit[1] for other in edits)]
+        edits = [trim_edit(old, *edit) for edit in edits]
+    if splice(old, edits) != replacement:
+        return [(start, end, replacement)]
+    return [(edit_start + start, edit_end + start, new) for edit_start, edit_end, new in edits]
+
+
+heading_re = re.compile(r'^(=+)(.+?)(=+)[ \t]*$', re.M)
+
+# Parts of the text where a heading is not a section heading
+hidden_re = re.compile(r'<!--.*?(?:-->|$)|<(nowiki|pre|math|ref|gallery|source|syntaxhighlight|poem|score|timeline|templatedata)\b[^>]*?(?:/>|>.*?(?:</\1\s*>|$))',
+                       re.S | re.I)
+
+
+def blank(text, ranges):
+    # Replace everything but newlines in the given ranges with spaces, so that the
+    # positions in the text stay the same
+    out = []
+    pos = 0
+    for start, end in ranges:
+        if end <= pos:
+            continue
+        start = max(start, pos)
+        out.append(text[pos:start])
+        out.append(re.sub(r'[^\n]', ' ', text[start:end]))
+        pos = end
+    out.append(text[pos:])
+    return ''.join(out)
+
+
+def find_sections(text):
+    """
+    Return the sections of the text as (number, start, end) tuples, numbered
+    as for section editing: 0 for the text before the first heading, and
+    from 1 for each heading. A section ends at the next heading of the same
+    or a higher level, so it includes its subsections. Headings in comments,
+    in extension tags like <ref> and <nowiki>, and in templates don't count.
+    """
+    ranges = [m.span() for m in hidden_re.finditer(text)]
+    ranges.extend((tpl.start, tpl.end) for tpl in scan_templates(text))
+    blanked = blank(text, sorted(ranges))
+    headings = [(m.start(), min(len(m.group(1)), len(m.group(3)), 6)) for m in heading_re.finditer(blanked)]
+
+    sections = [(0, 0, headings[0][0] if headings else len(text))]
+    for n, (start, level) in enumerate(headings):
+        end = len(text)
+        for next_start, next_level in headings[n + 1:]:
+            if next_level <= level:
+                end = next_start
+                break
+        sections.append((n + 1, start, end))
+    return sections
+
+
+def find_edit_section(text, edits):
+    """
+    Return the smallest section, as a (number, start, end) tuple, that holds
+    all the edits, or None if the edits are in different top-level sections.
+    """
+    first = min(edit[0] for edit in edits)
+    last = max(edit[1] for edit in edits)
+    found = None
+    for section in find_sections(text):
+        if section[1] <= first and last <= section[2] and (found is None or section[2] - section[1] < found[2] - found[1]):
+            found = section
+    return found
@@ -17,5 +17,7 @@ setup(name='cs1cleanup',
       url='https://github.com/danmichaelo/wikipedia-cs1cleanup',
       license='MIT',
       packages=['cs1cleanup'],
-      install_requires=['mwclient', 'mwtemplates', 'psutil', 'six']
+      package_data={'cs1cleanup': ['data/*.txt']},
+      install_requires=['mwclient', 'mwtemplates', 'psutil', 'six'],
+      extras_require={'bulk': ['pandas', 'pyarrow']}
       )
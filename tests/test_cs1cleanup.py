@@ -1,10 +1,29 @@
 # encoding=utf8
 from __future__ import unicode_literals
+import bz2
+import json
 import logging
+import pickle
+import threading
 import pytest
 import unittest
 import mock
-from cs1cleanup import DateValidator, YearValidator, get_date_suggestion, get_year_suggestion, pre_clean, Template, get_month
+import mwclient
+import requests
+import cs1cleanup.cs1cleanup as cs1cleanup_module
+from cs1cleanup.cache import LRUCache, call_logged
+from cs1cleanup.store import PageStateStore, SuggestionStore
+from cs1cleanup.correct import correct, match
+from cs1cleanup.lexicon import lexicon
+from cs1cleanup.dump import process_dump
+from cs1cleanup.fetch import category_pages, fetch_pages
+from cs1cleanup.pipeline import pipeline
+from cs1cleanup.throttle import EditScheduler
+from cs1cleanup.wikitext import scan_templates, find_templates, find_sections, find_edit_section, minimal_edits, splice
+from mwtemplates import TemplateEditor
+from mwclient.errors import MaximumRetriesExceeded
+from cs1cleanup import suggest_dates, validate_dates
+from cs1cleanup import Page, TemplateSnapshot, DateValidator, YearValidator, validate_date, validate_year, get_date_suggestion, get_year_suggestion, pre_clean, Template, get_month, get_month_or_season, get_shape, get_shape_rules, suggest_date, suggest_date_fuzzy, suggestion_rules, order_suggestion_rules, month_stopwords
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -83,11 +102,82 @@ def test_year_validator(test_input, expected):
     assert YearValidator(test_input).valid is expected
 
 
+@pytest.mark.parametrize('test_input,expected', [
+    ('1. januar 2014', (True, None)),
+    ('01. januar 2014', (False, 'Dag har 0-prefiks')),
+    ('2014-13-01', (False, 'Månedsnummer utenfor rekkevidde 1-12')),
+    ('1. jan 2014', (False, 'Ikke kjent navn på måned eller årstid')),
+    ('2100', (False, 'Publiseringsår mer enn ett år inn i fremtiden')),
+    ('24. des. 2009 00:03', (False, None)),
+])
+def test_validate_date(test_input, expected):
+    assert validate_date(test_input) == expected
+    assert validate_date(test_input) == expected  # cached
+    validator = DateValidator(test_input)
+    assert (validator.valid, validator.problem) == expected
+
+
+def test_validate_year():
+    assert validate_year('ca. 2014') == (True, None)
+    assert validate_year('[[2014]]') == (False, None)
+
+
+@pytest.mark.parametrize('test_input,expected', [
+    ('1. januar 2014', 'D. A D'),
+    ('2014-01-30', 'D-D-D'),
+    ('6AUG2012', 'DAD'),
+    ('høsten 2015', 'A D'),
+])
+def test_get_shape(test_input, expected):
+    assert get_shape(test_input) == expected
+
+
+def test_get_shape_rules():
+    assert [rule.name for rule in get_shape_rules('D-D')] == ['year_range', 'year_month']
+    assert get_shape_rules('A A A') == []
+
+
+def test_suggestion_rule_counters():
+    rule = [rule for rule in suggestion_rules if rule.name == 'iso'][0]
+    attempts, hits = rule.attempts, rule.hits
+    assert '2014-01-02' == suggest_date('2014.1.2')
+    assert '1.2.2014' == suggest_date('1.2.14')
+    assert (attempts + 2, hits + 1) == (rule.attempts, rule.hits)
+
+
+def test_order_suggestion_rules():
+    original = list(suggestion_rules)
+    try:
+        order_suggestion_rules(dict((rule.name, n) for n, rule in enumerate(original)))
+        names = [rule.name for rule in suggestion_rules]
+        assert names.index('year_range') < names.index('year_month')
+        assert names.index('month_year') < names.index('month_range')
+        assert names[0] == 'month_year'
+        assert '2004–2005' == suggest_date('2004-2005')
+    finally:
+        suggestion_rules[:] = original
+        order_suggestion_rules({})
+
+
 def test_pre_clean():
     # self.assertEqual('2006-10-01', pre_clean('[[2006]]-[[1. oktober|10-01]]'))
     assert '2006-1. oktober' == pre_clean('[[2006]]-[[1. oktober|10-01]]')
 
 
+@pytest.mark.parametrize('test_input', [
+    '[[2006]]-[[1. oktober|10-01]]',
+    ' {{Start date|2008|3|7|df=yes}} <!-- x -->',
+    '[[30. november]] 2010, kl. 14:12',
+    '(1.&ndash;2. mai 2010)',
+])
+def test_pre_clean_offsets(test_input):
+    cleaned, offsets = pre_clean(test_input, with_offsets=True)
+    assert cleaned == pre_clean(test_input)
+    assert len(offsets) == len(cleaned)
+    for char, offset in zip(cleaned, offsets):
+        assert char == test_input[offset] or char in '–-'
+
+
 @pytest.mark.parametrize('test_input,expected', [
     ('[[09.04.2008]]', '09.04.2008'),
     ('[[09-04-2008]]', '09.04.2008'),
@@ -1091,6 +1181,151 @@ def test_get_date_suggestion_large_set(test_input, expected):
     assert expected == get_date_suggestion(test_input, '(test)')
 
 
+@pytest.mark.parametrize('test_input,expected', [
+    ('ukjent', ['udatert']),
+    ('publisert 2. januar 2009', ['2. januar 2009']),
+    ('2009-01-02 og 3. feb 2010', ['2009-01-02', '3. februar 2010']),
+    ('2009-01-02 og 2009-01-02 og 2010-03-04', ['2009-01-02', '2009-01-02']),
+    ('ingen dato', []),
+])
+def test_suggest_date_fuzzy(test_input, expected):
+    assert expected == suggest_date_fuzzy(test_input)
+
+
+def test_suggest_dates():
+    values = ['Januari 2, 2009', '2009', 'Januari 2, 2009', 'foo']
+    expected = [get_date_suggestion(value, '(batch)') for value in values]
+    assert expected == suggest_dates(values)
+    assert expected == suggest_dates(values, processes=2, chunksize=1)
+
+
+def test_validate_dates():
+    values = ['2. januar 2009', '2. Januar 2009', '2. januar 2009', '']
+    expected = [validate_date(value) for value in values]
+    assert expected == validate_dates(values)
+    assert expected == validate_dates(values, processes=2, chunksize=1)
+
+
+def test_validate_dates_bulk():
+    pytest.importorskip('pandas')
+    from cs1cleanup.bulk import validate_dates_bulk
+    values = ['2014-01-01', '1. januar 2014', '01. januar 2014', '2014-13-01', 'januar 2014 <!-- x -->', '', None, '2099']
+    expected = [validate_date(value or '') for value in values]
+    mask, problems = validate_dates_bulk(values)
+    assert expected == list(zip(mask.tolist(), problems.tolist()))
+
+
+def test_get_date_suggestion_cached_log(caplog):
+    caplog.set_level(logging.INFO, logger='cs1cleanup')
+    for n in range(2):
+        caplog.clear()
+        assert '2. januar 2009' == get_date_suggestion('Januari 2, 2009', '(cached)')
+        assert ['(cached):"Januari 2, 2009" can be changed to "2. januar 2009"'] == [r.getMessage() for r in caplog.records]
+
+
+def test_call_logged_threads(caplog):
+    # Messages logged by other threads while the result is computed are not stored with it
+    caplog.set_level(logging.INFO, logger='cs1cleanup.test')
+    logger = logging.getLogger('cs1cleanup.test')
+    cache = LRUCache()
+    started = threading.Event()
+    logged = threading.Event()
+
+    def other():
+        started.wait()
+        logger.info('Saving 1 fixed date(s) on Other')
+        logged.set()
+
+    def func():
+        logger.info('Computing')
+        started.set()
+        logged.wait()
+        return 42
+
+    thread = threading.Thread(target=other)
+    thread.start()
+    assert call_logged(cache, logger, 'key', func) == 42
+    thread.join()
+
+    caplog.clear()
+    assert call_logged(cache, logger, 'key', func) == 42
+    assert ['Computing'] == [r.getMessage() for r in caplog.records]
+
+
+def test_suggestion_store(tmp_path):
+    path = str(tmp_path / 'suggestions.db')
+    store = SuggestionStore(path, 'v1')
+    store.set('Januari 2, 2009', '2. januar 2009')
+    store.close()
+
+    store = SuggestionStore(path, 'v1')
+    assert store.get('Januari 2, 2009') == '2. januar 2009'
+    store.close()
+
+    store = SuggestionStore(path, 'v2')
+    assert store.get('Januari 2, 2009') is None
+    store.close()
+
+
+def test_suggestion_store_bounded(tmp_path):
+    store = SuggestionStore(str(tmp_path / 'suggestions.db'), 'v1', cache_size=2)
+    values = ['Januari %d, 2009' % day for day in range(1, 6)]
+    for value in values:
+        store.set(value, 'x')
+    assert len(store.suggestions) == 2
+    assert len(store) == 5
+    assert [store.get(value) for value in values] == ['x'] * 5
+    assert store.get('Januari 6, 2009') is None
+    store.close()
+
+
+def test_ruleset_version():
+    # Stored suggestions are validated against the current year
+    version = cs1cleanup_module.get_ruleset_version()
+    assert version == cs1cleanup_module.get_ruleset_version()
+    page_version = cs1cleanup_module.get_page_state_version()
+    with mock.patch.object(cs1cleanup_module, 'current_year', cs1cleanup_module.current_year + 1):
+        assert version != cs1cleanup_module.get_ruleset_version()
+        # The page states depend on the ruleset too
+        assert page_version != cs1cleanup_module.get_page_state_version()
+
+
+def test_seed_suggestion_store_log(tmp_path, caplog):
+    # Seeding must not leave results in the caches that would be logged without their messages
+    history = tmp_path / 'modified-simple.txt'
+    history.write_bytes('Test\t2. sep 2009]\t2. september 2009\n'.encode('utf8'))
+    store = cs1cleanup_module.open_suggestion_store(str(tmp_path / 'suggestions.db'), str(history))
+    try:
+        caplog.set_level(logging.DEBUG, logger='cs1cleanup')
+        caplog.clear()
+        pre_clean('2. sep 2009]')
+        assert 'Pre-cleaned "2. sep 2009]" as "2. sep 2009"' in [r.getMessage() for r in caplog.records]
+    finally:
+        store.close()
+        cs1cleanup_module.suggestion_store = None
+
+
+def test_page_state_store(tmp_path):
+    path = str(tmp_path / 'pages.db')
+    unresolved = [{'key': 'dato', 'value': 'foo', 'problem': None, 'page': 'A'}]
+    store = PageStateStore(path, 'v1')
+    store.set('A', 10, 3, unresolved)
+    store.set('B', 20, 1, [])
+    store.close()
+
+    store = PageStateStore(path, 'v1')
+    assert store.is_current('A', 10)
+    assert not store.is_current('A', 11)
+    assert store.get('A') == (3, unresolved)
+    store.prune(['A'])
+    assert store.get('B') is None
+    store.close()
+
+    store = PageStateStore(path, 'v2')
+    assert len(store) == 0
+    store.close()
+
+
 def test_year_suggestions():
     assert '2014' == get_year_suggestion('[[2014]]')
     assert 'ca. 2014' == get_year_suggestion('Ca. 2014')
@@ -1100,6 +1335,191 @@ def test_month_suggestions():
     assert 'juni' == get_month('June')
 
 
+@pytest.mark.parametrize('test_input,expected', [
+    ('Sept.', 'september'),
+    ('Febr', 'februar'),
+    ('déc.', 'desember'),
+    ('Okt', 'oktober'),
+    ('jul', 'juli'),
+    ('ju', None),  # too short
+    ('jui', None),  # juin or juillet
+    ('juil', 'juli'),
+    ('janv', 'januar'),
+    ('høst', None),  # season
+])
+def test_lexicon_lookup(test_input, expected):
+    assert lexicon.lookup(test_input) == expected
+
+
+def test_ambiguous_month():
+    # A value that could be more than one month is left as it is
+    assert get_month('jui') is None
+    assert get_month_or_season('jui') is None
+
+
+def test_lexicon_lookup_seasons():
+    assert lexicon.lookup('høst', include_seasons=True) == 'høsten'
+    assert lexicon.lookup('Winter', include_seasons=True) == 'vinteren'
+    assert lexicon.lookup('jul', include_seasons=True) == 'juli'
+
+
+@pytest.mark.parametrize('test_input', ['for', 'lent', 'print', 'her', 'efter', 'aut', 'som', 'sum', 'vin', 'win', 'chris'])
+def test_no_season_prefixes(test_input):
+    # Season names are only matched exactly, these are prefixes of them
+    assert lexicon.lookup(test_input, include_seasons=True) is None
+    assert get_month_or_season(test_input) is None
+    assert get_date_suggestion('%s 2010' % test_input.capitalize(), 'dato') is None
+
+
+def test_month_stopwords():
+    # The stopword gate must not hide anything the lexicon or the corrector would find
+    for word in month_stopwords:
+        assert lexicon.lookup(word, include_seasons=True) is None, word
+        assert correct(word, allow_ambiguous=False) == word, word
+    assert get_month('Retrieved') is None
+
+
+@pytest.mark.parametrize('test_input,expected', [
+    ('novembir', 'november'),
+    ('sepember', 'september'),
+    ('hosten', 'høsten'),
+    ('mail', 'mai'),
+    ('published', 'published'),
+    ('retrieved', 'retrieved'),
+])
+def test_correct(test_input, expected):
+    assert correct(test_input) == expected
+
+
+def test_match():
+    assert match('jusi', 1) == [('juni', 1), ('juli', 1)]
+    assert match('novembir') == [('november', 1)]
+    assert match('published') == []
+    assert correct('jusi') == 'juni'
+    assert correct('jusi', allow_ambiguous=False) == 'jusi'
+    assert get_month('jusi') is None
+
+
+@pytest.mark.parametrize('test_input', [
+    '{{Kilde www|url=http://example.com|dato=1. januar 2014}}',
+    'a {{kilde www\n | dato = 2014 <!-- x|y=z --> | tittel=[[a|b]] {{lang|en|c=d}}\n}} b',
+    '{{Infobox|ref={{Cite web|date=2014|title={{{1|}}}}}}} {{Mal:Kilde bok|år=2014|dato=}}',
+    '{{Kilde www|dato=<nowiki>|</nowiki>2014|[[a|b}}]]}} {{Kilde avis|dato=2014}}',
+    '{{{{Kilde www|dato=2014}}}} {{Kilde www|dato=2014}',
+])
+def test_scan_templates(test_input):
+    te = TemplateEditor(test_input)
+    expected = sorted((tpl.key, [(p.key, p.value) for p in tpl.parameters]) for key in te.templates.keys() for tpl in te.templates[key])
+    assert expected == sorted((tpl.name, [(p.key, p.value) for p in tpl.params]) for tpl in scan_templates(test_input))
+
+
+def test_find_templates():
+    text = '{{Kilde www|dato=2014|tittel={{Kilde bok|år=2015}}}} {{Kilde bok|år=2016}}'
+    assert ['Kilde www', 'Kilde bok', 'Kilde bok'] == [tpl.name for tpl in find_templates(text, ['Kilde www', 'Kilde bok'])]
+    assert ['2014', '2016'] == [tpl.params[0].value for tpl in find_templates(text, ['Kilde www', 'Kilde bok'], nested=False)]
+
+
+@pytest.mark.parametrize('old,new,expected', [
+    ('x {{Kilde www | dato = 2014-1-2 | url=y}} z', '{{Kilde www | dato = 2014-01-02 | url=y}}', [(28, 30, '01-0')]),
+    ('{{Kilde www|år= 1951-53 \n|år=|url=y}}', '{{Kilde www|år=|url=y|dato= 1951–1953 \n}}', [(11, 25, ''), (35, 35, '|dato= 1951–1953 \n')]),
+    ('{{Kilde www|tittel={{Kilde bok|år=[[2014]]}}|dato=x}}', '{{Kilde www|tittel={{Kilde bok|år=2014}}|dato=x}}', [(34, 42, '2014')]),
+    ('{{Kilde www|dato={{Kilde bok|år=x}}}}', '{{Kilde www|dato=2014}}', [(0, 37, '{{Kilde www|dato=2014}}')]),
+])
+def test_minimal_edits(old, new, expected):
+    start = old.index('{{')
+    edits = minimal_edits(old, start, len(old) - (len(old) - old.rindex('}}') - 2), new)
+    assert expected == edits
+    assert old[:start] + new + old[old.rindex('}}') + 2:] == splice(old, edits)
+
+
+def test_page_prescan():
+    assert 2 == Page.prescan('{{Kilde www|dato=1. januar 2014|år=2014|tittel=x}} {{Infobox|dato=foo}}')
+    assert None is Page.prescan('{{Kilde www|dato=1. januar 2014}} {{Kilde bok|år=[[2014]]}}')
+
+
+def getPageMock(text):
+    page = mock.Mock()
+    page.name = 'Test'
+    page.text.return_value = text
+    page.save.return_value = {}
+    return page
+
+
+@mock.patch('cs1cleanup.cs1cleanup.time.sleep')
+def test_page_save(sleep):
+    text = 'Tekst {{Infobox|a=b}}\n<ref>{{Kilde www | url=x | dato = Januari 2, 2009 }}</ref> {{Kilde bok|år=2014}}'
+    page = getPageMock(text)
+    p = Page(page, False)
+    assert (2, 1, 0) == (p.checked, len(p.modified), len(p.unresolved))
+    page.save.assert_called_once_with(text.replace('Januari 2, 2009', '2. januar 2009'), summary=mock.ANY)
+
+
+@mock.patch('cs1cleanup.cs1cleanup.time.sleep')
+def test_page_save_later(sleep):
+    text = '<ref>{{Kilde www|dato=Januari 2, 2009}}</ref>'
+    page = getPageMock(text)
+    p = Page(page, False, save=False)
+    assert page.save.call_count == 0
+    p.save()
+    page.save.assert_called_once_with('<ref>{{Kilde www|dato=2. januar 2009}}</ref>', summary=mock.ANY)
+
+
+def test_pipeline():
+    assert list(pipeline(range(100), [lambda x: x * 2, lambda x: x + 1], queue_size=3)) == [x * 2 + 1 for x in range(100)]
+
+    def fail(x):
+        if x == 5:
+            raise ValueError(x)
+        return x
+
+    results = []
+    with pytest.raises(ValueError):
+        for x in pipeline(range(10), [fail], queue_size=2):
+            results.append(x)
+    assert results == [0, 1, 2, 3, 4]
+
+
+def test_find_sections():
+    text = 'Intro\n== A ==\na\n=== B ===\nb <!--\n== C ==\n-->\n{{x|\n== D ==\n}}\n== E ==\ne\n'
+    sections = find_sections(text)
+    assert [(0, 'Intro'), (1, '== A =='), (2, '=== B ==='), (3, '== E ==')] == [(n, text[start:end].split('\n')[0]) for n, start, end in sections]
+    assert sections[1][2] == sections[3][1]
+    assert find_edit_section(text, [(text.index('b <'), text.index('b <') + 1, 'c')]) == sections[2]
+    assert find_edit_section(text, [(0, 1, 'i'), (text.index('e\n'), text.index('e\n') + 1, 'f')]) is None
+
+
+@mock.patch('cs1cleanup.cs1cleanup.time.sleep')
+def test_page_save_section(sleep):
+    text = 'Intro {{Kilde www|dato=2014}}\n\n== A ==\n<ref>{{Kilde www|dato=Januari 2, 2009}}</ref>\n\n== B ==\nb\n'
+    page = getPageMock(text)
+    page.text.side_effect = lambda section=None, cache=True: text if section is None else '== A ==\n<ref>{{Kilde www|dato=Januari 2, 2009}}</ref>'
+    Page(page, False, section_saves=True)
+    page.save.assert_called_once_with('== A ==\n<ref>{{Kilde www|dato=2. januar 2009}}</ref>', summary=mock.ANY, section=1)
+
+
+@mock.patch('cs1cleanup.cs1cleanup.time.sleep')
+def test_page_save_section_changed(sleep):
+    # The page has been edited since it was fetched, so the section doesn't match. The whole page is
+    # saved with the timestamps of the fetched revision, so the server finds the edit conflict.
+    text = 'Intro {{Kilde www|dato=2014}}\n\n== A ==\n<ref>{{Kilde www|dato=Januari 2, 2009}}</ref>\n\n== B ==\nb\n'
+    page = getPageMock(text)
+    page.last_rev_time = 'fetched'
+    page.edit_time = 'started'
+
+    def get_text(section=None, cache=True):
+        if section is None:
+            return text
+        page.last_rev_time = page.edit_time = 'latest'
+        return '== A ==\n<ref>{{Kilde www|dato=Januari 2, 2009}}</ref> endret'
+
+    page.text.side_effect = get_text
+    timestamps = []
+    page.save.side_effect = lambda *args, **kwargs: timestamps.append((page.last_rev_time, page.edit_time)) or {}
+    Page(page, False, section_saves=True)
+    page.save.assert_called_once_with(text.replace('Januari 2, 2009', '2. januar 2009'), summary=mock.ANY)
+    assert timestamps == [('fetched', 'started')]
+
+
 @pytest.mark.parametrize('test_input,expected', [
     ({'utgivelsesår': '1951-53'}, {'utgivelsesår': None, 'dato': '1951–1953'}),
     ({'utgivelsesår': '1941', 'dato': 'januar-februar'}, {'utgivelsesår': None, 'dato': 'januar–februar 1941'}),
@@ -1116,5 +1536,233 @@ def test_complex1(test_input, expected):
             assert template.tpl.parameters[key].value == value, 'Field "%s" is "%s", expected "%s"' % (key, template.tpl.parameters[key].value, value)
 
 
+def test_template_snapshot():
+    snapshot = TemplateSnapshot('Kilde www', [('utgivelsesår', '1941'), ('dato', 'januar-februar')])
+    assert pickle.loads(pickle.dumps(snapshot)) == snapshot
+    with pytest.raises(AttributeError):
+        snapshot.name = 'Kilde bok'
+
+    template = Template(snapshot, False)
+    assert template.edits == [('edit', 1, 'januar–februar 1941'), ('remove', 'utgivelsesår')]
+    assert template.snapshot is snapshot
+    assert snapshot.params == (('utgivelsesår', '1941'), ('dato', 'januar-februar'))
+
+    template = Template(TemplateSnapshot('Kilde www', [('år', '1951-53')]), False)
+    assert template.edits == [('set', 'dato', '1951–1953'), ('remove', 'år')]
+
+
+def test_category_pages():
+    def page(pageid, title, text=None):
+        info = {'pageid': pageid, 'ns': 0, 'title': title, 'lastrevid': pageid * 10}
+        if text is not None:
+            info['revisions'] = [{'revid': pageid * 10, 'timestamp': '2014-01-02T03:04:05Z', 'slots': {'main': {'*': text}}}]
+        return info
+
+    site = mock.Mock()
+    site.get.side_effect = [
+        {'continue': {'rvcontinue': '2|20', 'gcmcontinue': 'page|B', 'continue': 'gcmcontinue||'},
+         'query': {'pages': {'1': page(1, 'A', 'a'), '2': page(2, 'B')}}},
+        {'batchcomplete': '', 'continue': {'gcmcontinue': 'page|C', 'continue': 'gcmcontinue||'},
+         'query': {'pages': {'1': page(1, 'A'), '2': page(2, 'B', 'b')}}},
+        {'batchcomplete': '', 'query': {'pages': {'3': page(3, 'C', 'c')}}},
+    ]
+    pages = list(category_pages(site, 'Kategori:X', batch_size=2))
+    assert [(p.name, p.text(), p.revision) for p in pages] == [('A', 'a', 10), ('B', 'b', 20), ('C', 'c', 30)]
+    assert pages[0].last_rev_time.tm_year == 2014
+    assert site.get.call_count == 3
+    assert site.get.call_args_list[1][1]['rvcontinue'] == '2|20'
+    assert 'rvcontinue' not in site.get.call_args_list[2][1]
+    assert site.get.call_args_list[2][1]['gcmcontinue'] == 'page|C'
+
+
+def test_fetch_pages():
+    site = mock.Mock()
+    site.get.side_effect = [
+        {'batchcomplete': '', 'query': {'pages': {
+            '2': {'pageid': 2, 'ns': 0, 'title': 'B', 'revisions': [{'revid': 20, 'timestamp': '2014-01-02T03:04:05Z', '*': 'b'}]},
+            '1': {'pageid': 1, 'ns': 0, 'title': 'A', 'revisions': [{'revid': 10, 'timestamp': '2014-01-02T03:04:05Z', '*': 'a'}]},
+        }}},
+        {'batchcomplete': '', 'query': {'pages': {
+            '-1': {'ns': 0, 'title': 'C', 'missing': ''},
+        }}},
+    ]
+    pages = list(fetch_pages(site, ['A', 'B', 'C'], batch_size=2))
+    assert [(p.name, p.prefetched_text, p.exists) for p in pages] == [('A', 'a', True), ('B', 'b', True), ('C', None, False)]
+    assert site.get.call_args_list[0][1]['titles'] == 'A|B'
+
+
+class FakeTime(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@mock.patch('cs1cleanup.throttle.time', new_callable=FakeTime)
+def test_edit_scheduler(fake_time):
+    scheduler = EditScheduler(rate=0.5, burst=2)
+    starts = []
+    for i in range(4):
+        scheduler.run(lambda: starts.append(fake_time.now))
+    assert starts == [1000, 1000, 1002, 1004]
+    assert scheduler.throttled == 4
+
+    # Time between edits counts towards the next ones
+    fake_time.now += 10
+    scheduler.run(lambda: starts.append(fake_time.now))
+    assert starts[-1] == 1014
+
+    # Waiting for the server holds back the next edit, and isn't counted as working
+    scheduler.run(lambda: scheduler.back_off(30))
+    assert scheduler.backed_off == 30
+    assert scheduler.working == 0
+    scheduler.run(lambda: starts.append(fake_time.now))
+    assert starts[-1] == 1044
+    assert scheduler.edits == 7
+
+
+class FakeAdapter(requests.adapters.BaseAdapter):
+    # Gives the responses, as (status, headers, body), in turn
+
+    def __init__(self, responses):
+        super(FakeAdapter, self).__init__()
+        self.responses = list(responses)
+
+    def send(self, request, **kwargs):
+        status, headers, body = self.responses.pop(0)
+        response = requests.Response()
+        response.status_code = status
+        response.headers.update(headers)
+        response._content = body.encode('utf8')
+        response.request = request
+        response.url = request.url
+        return response
+
+    def close(self):
+        pass
+
+
+def scheduled_site(scheduler, responses):
+    session = requests.Session()
+    session.mount('https://', FakeAdapter(responses))
+    site = mwclient.Site('no.wikipedia.org', pool=session, do_init=False, max_retries=2, retry_timeout=5)
+    scheduler.install(site)
+    return site
+
+
+@mock.patch('cs1cleanup.throttle.time', new_callable=FakeTime)
+def test_edit_scheduler_install(fake_time):
+    scheduler = EditScheduler()
+    site = scheduled_site(scheduler, [])
+    sleeper = site.sleepers.make()
+    sleeper.sleep(8)
+    sleeper.sleep()
+    assert scheduler.backed_off == 13
+    with pytest.raises(MaximumRetriesExceeded):
+        sleeper.sleep()
+
+
+@mock.patch('cs1cleanup.throttle.time', new_callable=FakeTime)
+def test_edit_scheduler_retry_after(fake_time):
+    # mwclient raises on 429, and waits on 503 without looking at Retry-After
+    scheduler = EditScheduler()
+    site = scheduled_site(scheduler, [
+        (429, {'Retry-After': '7'}, ''),
+        (503, {'Retry-After': '20'}, ''),
+        (200, {}, '{"batchcomplete": ""}'),
+    ])
+    assert site.get('query') == {'batchcomplete': ''}
+    assert scheduler.backed_off == 27
+    assert scheduler.not_before == fake_time.now
+
+    site = scheduled_site(scheduler, [(429, {'Retry-After': '1'}, '')] * 3)
+    with pytest.raises(MaximumRetriesExceeded):
+        site.get('query')
+
+
+dump_xml = """<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/" version="0.10" xml:lang="nb">
+  <siteinfo><sitename>Wikipedia</sitename></siteinfo>
+  <page><title>A</title><ns>0</ns><id>1</id>
+    <revision><id>10</id><text xml:space="preserve">&lt;ref&gt;{{Kilde www|dato=Januari 2, 2009|år=foo}}&lt;/ref&gt;</text></revision>
+  </page>
+  <page><title>B</title><ns>0</ns><id>2</id>
+    <revision><id>20</id><text xml:space="preserve">{{Kilde www|dato=2014}}</text></revision>
+  </page>
+  <page><title>C</title><ns>0</ns><id>3</id><redirect title="A" />
+    <revision><id>30</id><text xml:space="preserve">#OMDIRIGERING [[A]] {{Kilde www|dato=Januari 2, 2009}}</text></revision>
+  </page>
+  <page><title>Mal:D</title><ns>10</ns><id>4</id>
+    <revision><id>40</id><text xml:space="preserve">{{Kilde www|dato=Januari 2, 2009}}</text></revision>
+  </page>
+</mediawiki>
+"""
+
+
+def test_process_dump(tmp_path):
+    path = str(tmp_path / 'pages-articles.xml.bz2')
+    output = str(tmp_path / 'dump.jsonl')
+    with bz2.BZ2File(path, 'w') as f:
+        f.write(dump_xml.encode('utf8'))
+    cnt = process_dump(path, output)
+    assert cnt == {'pagesChecked': 2, 'datesChecked': 3, 'datesModified': 1, 'datesUnresolved': 1, 'errors': 0}
+    with open(output, 'rb') as f:
+        results = [json.loads(line.decode('utf8')) for line in f]
+    assert len(results) == 1
+    assert (results[0]['title'], results[0]['revid']) == ('A', 10)
+    assert results[0]['modified'][0]['new'] == '2. januar 2009'
+    assert results[0]['unresolved'][0]['value'] == 'foo'
+    assert splice('<ref>{{Kilde www|dato=Januari 2, 2009|år=foo}}</ref>', results[0]['edits']) == '<ref>{{Kilde www|dato=2. januar 2009|år=foo}}</ref>'
+
+
+# A page that can't be parsed, before the others
+bad_page = ('<page><title>E</title><ns>0</ns><id>5</id><revision><id>50</id><text xml:space="preserve">'
+            '{{Kilde www|dato=1.2.14&lt;!--c--&gt;}}</text></revision></page>\n  ')
+bad_dump_xml = dump_xml.replace('<page>', bad_page + '<page>', 1)
+
+
+def test_process_dump_error(tmp_path):
+    # The page that can't be parsed doesn't stop the pages after it from being checked
+    path = str(tmp_path / 'pages-articles.xml')
+    output = str(tmp_path / 'dump.jsonl')
+    with open(path, 'wb') as f:
+        f.write(bad_dump_xml.encode('utf8'))
+    cnt = process_dump(path, output)
+    assert cnt == {'pagesChecked': 2, 'datesChecked': 3, 'datesModified': 1, 'datesUnresolved': 1, 'errors': 1}
+    with open(output, 'rb') as f:
+        assert [json.loads(line.decode('utf8'))['title'] for line in f] == ['A']
+
+
+def test_process_dump_multistream(tmp_path):
+    # One stream with the header, one for each two pages, and one with the end tag.
+    # The page that can't be parsed must not stop the task it is in.
+    start = bad_dump_xml.index('<page>')
+    end = bad_dump_xml.index('</mediawiki>')
+    pages = [page + '</page>' for page in bad_dump_xml[start:end].split('</page>')[:-1]]
+    streams = [bad_dump_xml[:start]] + [''.join(pages[i:i + 2]) for i in range(0, len(pages), 2)] + [bad_dump_xml[end:]]
+    path = str(tmp_path / 'pages-articles-multistream.xml.bz2')
+    index = str(tmp_path / 'pages-articles-multistream-index.txt')
+    offset = 0
+    with open(path, 'wb') as f, open(index, 'wb') as idx:
+        for n, stream in enumerate(streams):
+            data = bz2.compress(stream.encode('utf8'))
+            if 0 < n < len(streams) - 1:
+                idx.write(('%d:%d:x\n%d:%d:y\n' % (offset, n, offset, n)).encode('utf8'))
+            f.write(data)
+            offset += len(data)
+
+    process_dump(path, str(tmp_path / 'dump.jsonl'))
+    expected = (tmp_path / 'dump.jsonl').read_bytes()
+    for processes in [1, 2]:
+        output = str(tmp_path / ('dump%d.jsonl' % processes))
+        cnt = process_dump(path, output, index, processes, streams_per_task=1)
+        assert cnt == {'pagesChecked': 2, 'datesChecked': 3, 'datesModified': 1, 'datesUnresolved': 1, 'errors': 1}
+        assert (tmp_path / ('dump%d.jsonl' % processes)).read_bytes() == expected
+
+
 if __name__ == '__main__':
     unittest.main()